@@ -0,0 +1,61 @@
+"""
+Non-blocking access to a cacheandra cache
+"""
+
+from .concurrency import Future, get_executor
+
+def _first(values):
+    return values[0]
+
+class AsyncCacheClient(object):
+    """
+    Calls a CacheBackend on a pool of async_pool_size threads per process, so that the caller can carry on
+    while they're made and keep many of them going at once. Every method returns a Future - call get() on it
+    for the result. Reads go through memcached to cassandra as get and get_many do, and writes send their
+    memcached and cassandra halves at the same time.
+
+        client = AsyncCacheClient(get_cache('default'))
+        pending = [client.aget(key) for key in keys]
+        values = [p.get(timeout=1) for p in pending]
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._executor = get_executor(cache._cacheandra_options['async_pool_size'], 'async')
+
+    def _call(self, func, *args):
+        return Future([self._executor.apply_async(func, args)])
+
+    def _both(self, memcached, cassandra, *args):
+        return Future([self._executor.apply_async(memcached, args),
+                       self._executor.apply_async(cassandra, args)], _first)
+
+    def aget(self, key, default=None, version=None):
+        return self._call(self.cache.get, key, default, version)
+
+    def aget_many(self, keys, version=None):
+        # the cassandra reads for the keys memcached doesn't have are made concurrently in chunks by get_many
+        return self._call(self.cache.get_many, keys, version)
+
+    def aset(self, key, value, timeout=0, version=None):
+        if self.cache._large_value_threshold:
+            # the size of the value decides whether it goes into memcached
+            return self._call(self.cache.set, key, value, timeout, version)
+        key = self.cache.make_key(key, version=version)
+        return self._both(self.cache._set_memcached, self.cache._set_cassandra, key, value, timeout)
+
+    def aset_many(self, data, timeout=0, version=None):
+        if self.cache._large_value_threshold:
+            return self._call(self.cache.set_many, data, timeout, version)
+        data = dict((self.cache.make_key(key, version=version), value) for key, value in data.items())
+        return self._both(self.cache._set_many_memcached, self.cache._set_many_cassandra, data, timeout)
+
+    def adelete(self, key, version=None):
+        key = self.cache.make_key(key, version=version)
+        return self._both(self.cache._delete_memcached, self.cache._delete_cassandra, key)
+
+    def aincr(self, key, delta=1, version=None):
+        return self._call(self.cache.incr, key, delta, version)
+
+    def adecr(self, key, delta=1, version=None):
+        return self._call(self.cache.decr, key, delta, version)
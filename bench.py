@@ -0,0 +1,638 @@
+"""
+Benchmarks for cacheandra
+
+Runs get, set, get_many, set_many and incr against memcached only, cassandra only and both, for a range of
+value sizes, key counts and hit ratios, with in-process stand-ins for pylibmc.Client and pycassa.ColumnFamily
+so nothing else needs to be running. The stand-ins can add latency to every call and fail a fraction of them.
+
+    python -m cacheandra.bench --output before.json
+    ... change things ...
+    python -m cacheandra.bench --output after.json --compare before.json
+
+writes p50, p99 (in milliseconds) and operations per second for each benchmark, and with --compare shows
+the change from an earlier run and exits non zero if anything got slower by more than --threshold.
+It also times a memcached only backend against calling its client directly, to show what each call costs on
+top, and loading the backend and setting up a cache in new processes, against --startup-target.
+Keys and values come from a seeded random number generator, so runs are repeatable.
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+import cPickle as pickle
+
+from django.conf import ENVIRONMENT_VARIABLE, settings
+
+import _pylibmc
+import pylibmc
+from pycassa import NotFoundException, TimedOutException
+
+from .keys import RANDOM_PARTITIONER, cassandra_token
+
+"""
+Stand-ins for the servers
+"""
+
+class Latency(object):
+    """
+    What every call to a stand-in costs: latency seconds, plus up to jitter more, and failing failure_rate of
+    the time with the exception error() makes
+    """
+
+    def __init__(self, latency=0, jitter=0, failure_rate=0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self.calls = 0
+
+    def __call__(self, error):
+        self.calls += 1
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self._random.uniform(0, self.jitter))
+        if self.failure_rate and self._random.random() < self.failure_rate:
+            raise error()
+
+def _memcached_down():
+    # what pylibmc raises for a server that has stopped answering
+    return _pylibmc.ServerDown('error 47 from memcached_get(key): (0x0) SERVER HAS FAILED AND IS DISABLED UNTIL TIMED RETRY,'
+                               '  host: 127.0.0.1:1 -> libmemcached/get.cc:314')
+
+class FakeMemcached(object):
+    """
+    A pylibmc.Client that keeps everything in a dict. Values are pickled going in and out, as pylibmc does.
+    """
+
+    def __init__(self, latency=None):
+        self.latency = latency or Latency()
+        self._data = {}
+
+    def _expiry(self, time_):
+        if not time_:
+            return None
+        if time_ > 2592000:
+            return time_
+        return time.time() + time_
+
+    def _get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[1] is not None and item[1] <= time.time():
+            del self._data[key]
+            return None
+        return item
+
+    def get(self, key):
+        self.latency(_memcached_down)
+        item = self._get(key)
+        return None if item is None else pickle.loads(item[0])
+
+    def get_multi(self, keys):
+        self.latency(_memcached_down)
+        ret = {}
+        for key in keys:
+            item = self._get(key)
+            if item is not None:
+                ret[key] = pickle.loads(item[0])
+        return ret
+
+    def set(self, key, value, time=0):
+        self.latency(_memcached_down)
+        self._data[key] = (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), self._expiry(time))
+        return True
+
+    def set_multi(self, mapping, time=0):
+        self.latency(_memcached_down)
+        expiry = self._expiry(time)
+        for key, value in mapping.iteritems():
+            self._data[key] = (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), expiry)
+        return []
+
+    def add(self, key, value, time=0):
+        self.latency(_memcached_down)
+        if self._get(key) is not None:
+            return False
+        self._data[key] = (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), self._expiry(time))
+        return True
+
+    def delete(self, key):
+        self.latency(_memcached_down)
+        return self._data.pop(key, None) is not None
+
+    def delete_multi(self, keys):
+        self.latency(_memcached_down)
+        for key in keys:
+            self._data.pop(key, None)
+        return True
+
+    def _change(self, key, delta):
+        item = self._get(key)
+        if item is None:
+            raise pylibmc.NotFound(key)
+        value = max(pickle.loads(item[0]) + delta, 0)
+        self._data[key] = (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), item[1])
+        return value
+
+    def incr(self, key, delta=1):
+        self.latency(_memcached_down)
+        return self._change(key, delta)
+
+    def decr(self, key, delta=1):
+        self.latency(_memcached_down)
+        return self._change(key, -delta)
+
+    def flush_all(self):
+        self._data.clear()
+
+    def disconnect_all(self):
+        pass
+
+class FakeBatch(object):
+    """
+    What ColumnFamily.batch() returns - the mutations are made, in one call, on send()
+    """
+
+    def __init__(self, cf):
+        self._cf = cf
+        self._mutations = []
+
+    # timestamps are ignored - mutations are made in the order they're given
+
+    def insert(self, key, columns, ttl=None, timestamp=None):
+        self._mutations.append((self._cf._insert, (key, columns, ttl)))
+
+    def remove(self, key, columns=None, timestamp=None):
+        self._mutations.append((self._cf._remove, (key, columns)))
+
+    def send(self):
+        self._cf.latency(TimedOutException)
+        mutations, self._mutations = self._mutations, []
+        for func, args in mutations:
+            func(*args)
+
+class FakeMutator(object):
+    """
+    A pycassa.batch.Mutator, for changes to more than one FakeColumnFamily sent in one call
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self._mutations = []
+
+    def insert(self, cf, key, columns, ttl=None, timestamp=None):
+        self._mutations.append((cf._insert, (key, columns, ttl)))
+
+    def remove(self, cf, key, columns=None, timestamp=None):
+        self._mutations.append((cf._remove, (key, columns)))
+
+    def send(self):
+        self.latency(TimedOutException)
+        mutations, self._mutations = self._mutations, []
+        for func, args in mutations:
+            func(*args)
+
+class FakeConnection(object):
+    """
+    A connection from a pycassa.ConnectionPool, with only the calls the backend makes on one directly
+    """
+
+    def __init__(self, partitioner):
+        self.partitioner = partitioner
+
+    def get(self):
+        # it's its own pool
+        return self
+
+    def describe_partitioner(self):
+        return self.partitioner
+
+    def return_to_pool(self):
+        pass
+
+class FakeColumnFamily(object):
+    """
+    A pycassa.ColumnFamily that keeps rows in a dict of key -> {column: (value, expiry)}. Both value and
+    counter column families are made from it - inserting into a counter column family adds to the counters.
+    get_range places keys as partitioner would.
+    """
+
+    def __init__(self, latency=None, counter=False, partitioner=RANDOM_PARTITIONER):
+        self.latency = latency or Latency()
+        self.counter = counter
+        self.partitioner = partitioner
+        self.pool = FakeConnection(partitioner)
+        self._rows = {}
+
+    def _row(self, key, columns):
+        row = self._rows.get(key)
+        if row is None:
+            return None
+        now = time.time()
+        ret = {}
+        for name in (columns if columns is not None else row.keys()):
+            column = row.get(name)
+            if column is not None and (column[1] is None or column[1] > now):
+                ret[name] = column[0]
+        return ret or None
+
+    def _insert(self, key, columns, ttl=None):
+        if self.counter:
+            current = self._row(key, columns.keys()) or {}
+            columns = dict((name, current.get(name, 0) + value) for name, value in columns.iteritems())
+        expiry = None if ttl is None else time.time() + ttl
+        row = self._rows.setdefault(key, {})
+        for name, value in columns.iteritems():
+            row[name] = (value, expiry)
+
+    def _remove(self, key, columns=None):
+        if columns is None:
+            self._rows.pop(key, None)
+            return
+        row = self._rows.get(key, {})
+        for name in columns:
+            row.pop(name, None)
+        if not row:
+            self._rows.pop(key, None)
+
+    def get(self, key, columns=None):
+        self.latency(TimedOutException)
+        row = self._row(key, columns)
+        if row is None:
+            raise NotFoundException()
+        return row
+
+    def multiget(self, keys, columns=None):
+        self.latency(TimedOutException)
+        ret = {}
+        for key in keys:
+            row = self._row(key, columns)
+            if row is not None:
+                ret[key] = row
+        return ret
+
+    def xget(self, key, column_start='', column_finish='', buffer_size=None):
+        self.latency(TimedOutException)
+        row = self._row(key, None) or {}
+        for name in sorted(row):
+            if name >= column_start and (not column_finish or name <= column_finish):
+                yield name, row[name]
+
+    def get_range(self, start_token=None, finish_token=None, columns=None, buffer_size=None):
+        self.latency(TimedOutException)
+        for key in list(self._rows):
+            token = cassandra_token(key, self.partitioner)
+            if start_token is not None and not long(start_token) < token <= long(finish_token):
+                continue
+            row = self._row(key, columns)
+            if row is not None:
+                yield key, row
+
+    def insert(self, key, columns, ttl=None, timestamp=None):
+        self.latency(TimedOutException)
+        self._insert(key, columns, ttl)
+
+    def remove(self, key, columns=None, timestamp=None):
+        self.latency(TimedOutException)
+        self._remove(key, columns)
+
+    def add(self, key, column, value=1):
+        self.latency(TimedOutException)
+        self._insert(key, {column: value})
+
+    def remove_counter(self, key, column):
+        self.latency(TimedOutException)
+        self._remove(key, [column])
+
+    def batch(self, queue_size=100):
+        return FakeBatch(self)
+
+    def truncate(self):
+        self._rows.clear()
+
+"""
+Benchmarks
+"""
+
+MEMCACHED = 'memcached'
+CASSANDRA = 'cassandra'
+DUAL = 'dual'
+TIERS = (MEMCACHED, CASSANDRA, DUAL)
+
+_backends = 0
+
+def make_backend(tier, options=None, memcached_latency=None, cassandra_latency=None,
+                 partitioner=RANDOM_PARTITIONER):
+    """
+    A CacheBackend for tier using the stand-ins, with a cassandra that uses partitioner. Each one gets servers
+    of its own, so that no per process state - circuit breakers, queues and so on - is shared between
+    benchmarks.
+    """
+    # loading the backend reads the django settings, which main() may have to set up first
+    from . import cacheandra
+    global _backends
+    _backends += 1
+    servers = '127.0.0.1:%d' % (20000 + _backends) if tier in (MEMCACHED, DUAL) else ''
+    params = {'OPTIONS': dict(options or {}), 'TIMEOUT': 3600}
+    if tier in (CASSANDRA, DUAL):
+        params['CASSANDRA'] = ['127.0.0.1:%d' % (30000 + _backends)]
+        params['KEYSPACE'] = 'bench'
+        params['COLUMNFAMILY'] = 'cache'
+    backend = cacheandra.CacheBackend(servers, params)
+    if tier in (CASSANDRA, DUAL):
+        # the backend finds its column families already connected when it first uses them
+        cf = FakeColumnFamily(cassandra_latency, partitioner=partitioner)
+        countercf = FakeColumnFamily(cassandra_latency, counter=True, partitioner=partitioner)
+        cacheandra._connections[backend._connection_key()] = (os.getpid(), cf, countercf)
+        backend._mutator = lambda queue_size: FakeMutator(cassandra_latency or Latency())
+    # one client for every thread - the write behind, refresh and async pools as well as this one. Without
+    # memcached servers it's only used by close() and clear()
+    backend._local = SharedClient(FakeMemcached(memcached_latency))
+    return backend
+
+class SharedClient(object):
+    """
+    Stands in for a backend's thread local, so that all threads see the same client
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+class Benchmark(object):
+    """
+    One operation against one tier with one shape of data. setup() fills the cache, run(i) makes the i'th call.
+    """
+
+    def __init__(self, op, tier, value_size=100, keys=1, hit_ratio=1.0, options=None, seed=0):
+        self.op = op
+        self.tier = tier
+        self.value_size = value_size
+        self.keys = keys
+        self.hit_ratio = hit_ratio
+        self.options = options or {}
+        self.seed = seed
+
+    @property
+    def name(self):
+        name = '%s/%s/size=%d/keys=%d/hits=%g' % (self.op, self.tier, self.value_size, self.keys, self.hit_ratio)
+        if self.options:
+            name += '/' + ','.join('%s=%s' % item for item in sorted(self.options.items()))
+        return name
+
+    def setup(self, backend, iterations):
+        self.backend = backend
+        rnd = random.Random(self.seed)
+        value = ''.join(chr(rnd.randint(32, 126)) for i in range(self.value_size))
+        self._value = value
+        self._batches = []
+        present = []
+        for i in range(iterations):
+            batch = []
+            for j in range(self.keys):
+                if self.op in ('set', 'set_many') or rnd.random() >= self.hit_ratio:
+                    batch.append('missing-%d-%d' % (i, j))
+                else:
+                    batch.append('key-%d-%d' % (i, j))
+                    present.append(batch[-1])
+            self._batches.append(batch)
+        if self.op == 'incr':
+            for key in present:
+                backend.set(key, 0)
+        else:
+            backend.set_many(dict((key, value) for key in present))
+
+    def run(self, i):
+        batch = self._batches[i]
+        if self.op == 'get':
+            self.backend.get(batch[0])
+        elif self.op == 'set':
+            self.backend.set(batch[0], self._value)
+        elif self.op == 'get_many':
+            self.backend.get_many(batch)
+        elif self.op == 'set_many':
+            self.backend.set_many(dict((key, self._value) for key in batch))
+        elif self.op == 'delete_many':
+            self.backend.delete_many(batch)
+        elif self.op == 'incr':
+            try:
+                self.backend.incr(batch[0])
+            except ValueError:
+                pass
+
+def default_benchmarks():
+    benchmarks = []
+    for tier in TIERS:
+        for size in (100, 10000):
+            benchmarks.append(Benchmark('set', tier, size))
+            for hit_ratio in (1.0, 0.5, 0.0):
+                benchmarks.append(Benchmark('get', tier, size, hit_ratio=hit_ratio))
+        for keys in (10, 100):
+            benchmarks.append(Benchmark('set_many', tier, keys=keys))
+            for hit_ratio in (1.0, 0.5):
+                benchmarks.append(Benchmark('get_many', tier, keys=keys, hit_ratio=hit_ratio))
+        benchmarks.append(Benchmark('incr', tier))
+    benchmarks.append(Benchmark('incr', DUAL, options={'counter_mode': 'fast'}))
+    benchmarks.append(Benchmark('delete_many', DUAL, keys=100))
+    benchmarks.append(Benchmark('get', DUAL, options={'l0_max_entries': 10000}))
+    benchmarks.append(Benchmark('set', DUAL, options={'write_behind': True}))
+    return benchmarks
+
+def _percentile(ordered, fraction):
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def run_benchmark(benchmark, iterations=1000, memcached_latency=None, cassandra_latency=None):
+    """
+    Runs benchmark iterations times, returning a dict of p50, p99 and mean in milliseconds and ops per second
+    """
+    backend = make_backend(benchmark.tier, benchmark.options, memcached_latency, cassandra_latency)
+    benchmark.setup(backend, iterations)
+    times = []
+    started = time.time()
+    for i in range(iterations):
+        start = time.time()
+        benchmark.run(i)
+        times.append(time.time() - start)
+    elapsed = time.time() - started
+    backend.close()
+    return _result(times, elapsed)
+
+def _result(times, elapsed):
+    times = sorted(times)
+    return {
+        'p50': _percentile(times, 0.5) * 1000,
+        'p99': _percentile(times, 0.99) * 1000,
+        'mean': sum(times) / len(times) * 1000,
+        'ops': len(times) / elapsed if elapsed else 0,
+    }
+
+def run_benchmarks(benchmarks=None, iterations=1000, latency=0, jitter=0, failure_rate=0, seed=0, out=None):
+    """
+    Runs benchmarks (the defaults if None) and returns a report of name -> result
+    """
+    report = {}
+    if benchmarks is None:
+        benchmarks = default_benchmarks()
+    for benchmark in benchmarks:
+        memcached_latency = Latency(latency, jitter, failure_rate, seed)
+        cassandra_latency = Latency(latency, jitter, failure_rate, seed + 1)
+        report[benchmark.name] = result = run_benchmark(benchmark, iterations, memcached_latency, cassandra_latency)
+        if out is not None:
+            out.write('%-70s p50 %8.3fms  p99 %8.3fms  %10.0f ops/s\n' %
+                      (benchmark.name, result['p50'], result['p99'], result['ops']))
+    return report
+
+"""
+Overhead
+"""
+
+def run_overhead(iterations=10000):
+    """
+    Times get, set, get_many and incr on a memcached only backend, and the same calls made straight to its client
+    with django's make_key - all a plain memcached backend such as PyLibMCCache does. Returns results for both,
+    as overhead/<op>/cacheandra and overhead/<op>/plain, the same as run_benchmark's.
+    """
+    backend = make_backend(MEMCACHED)
+    client = backend._cache
+    make_key = super(backend.__class__, backend).make_key
+    timeout = backend._get_memcache_timeout(0)
+    keys = ['key-%d' % i for i in range(100)]
+    backend.set_many(dict.fromkeys(keys, 'value'))
+    backend.set('counter', 0)
+    ops = {
+        'get': (lambda i: backend.get(keys[i % 100]),
+                lambda i: client.get(make_key(keys[i % 100]))),
+        'set': (lambda i: backend.set(keys[i % 100], 'value'),
+                lambda i: client.set(make_key(keys[i % 100]), 'value', timeout)),
+        'get_many': (lambda i: backend.get_many(keys[:10]),
+                     lambda i: client.get_multi([make_key(key) for key in keys[:10]])),
+        'incr': (lambda i: backend.incr('counter'),
+                 lambda i: client.incr(make_key('counter'), 1)),
+    }
+    report = {}
+    for op, calls in ops.items():
+        for name, call in zip(('cacheandra', 'plain'), calls):
+            times = []
+            started = time.time()
+            for i in range(iterations):
+                start = time.time()
+                call(i)
+                times.append(time.time() - start)
+            report['overhead/%s/%s' % (op, name)] = _result(times, time.time() - started)
+    backend.close()
+    return report
+
+"""
+Startup
+"""
+
+# milliseconds a new worker may take to load the backend and set up a cache
+STARTUP_TARGET = 100
+
+_STARTUP_SCRIPT = """
+import sys, time
+from django.conf import settings
+settings.configure()
+start = time.time()
+from %(package)s import cacheandra
+loaded = time.time()
+cacheandra.CacheBackend('127.0.0.1:11211', {'CASSANDRA': ['10.255.255.1:9160'], 'OPTIONS': %(options)r})
+sys.stdout.write('%%f %%f' %% (loaded - start, time.time() - loaded))
+"""
+
+def run_startup(runs=5, options=None):
+    """
+    Starts runs new python processes, each of which loads the backend and sets up a cache whose cassandra server
+    never answers, and returns the results for loading (startup/import) and setting up (startup/setup) - the
+    same as run_benchmark's
+    """
+    # __package__ rather than __name__, which is __main__ when run with python -m
+    script = _STARTUP_SCRIPT % {'package': __package__, 'options': options or {}}
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path or os.getcwd() for path in sys.path))
+    loads, setups = [], []
+    for i in range(runs):
+        load, setup = map(float, subprocess.check_output([sys.executable, '-c', script], env=env).split())
+        loads.append(load)
+        setups.append(setup)
+    return {
+        'startup/import': _result(loads, sum(loads)),
+        'startup/setup': _result(setups, sum(setups)),
+    }
+
+def compare(before, after, threshold=0.2, out=sys.stdout):
+    """
+    Writes the change in p50, p99 and ops per second for the benchmarks in both reports, and returns the names
+    of those that got slower by more than threshold (a fraction) on any of them
+    """
+    slower = []
+    for name in sorted(set(before) & set(after)):
+        b, a = before[name], after[name]
+        changes = {}
+        for stat in ('p50', 'p99'):
+            changes[stat] = (a[stat] - b[stat]) / b[stat] if b[stat] else 0
+        changes['ops'] = (b['ops'] - a['ops']) / b['ops'] if b['ops'] else 0
+        worse = [stat for stat, change in changes.items() if change > threshold]
+        if worse:
+            slower.append(name)
+        out.write('%-70s p50 %+6.0f%%  p99 %+6.0f%%  ops/s %+6.0f%%%s\n' %
+                  (name, changes['p50'] * 100, changes['p99'] * 100, -changes['ops'] * 100,
+                   '  SLOWER' if worse else ''))
+    return slower
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark cacheandra against in-process memcached and cassandra')
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every server call')
+    parser.add_argument('--jitter', type=float, default=0, help='up to this many more seconds, at random')
+    parser.add_argument('--failure-rate', type=float, default=0, help='fraction of server calls that fail')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--filter', default=None, help='only run benchmarks whose names contain this')
+    parser.add_argument('--output', default=None, help='write the report to this file as json')
+    parser.add_argument('--compare', default=None, help='compare with the report in this file')
+    parser.add_argument('--threshold', type=float, default=0.2, help='fraction slower that counts as a regression')
+    parser.add_argument('--overhead-iterations', type=int, default=10000,
+                        help='calls to time a memcached only backend against its client with, 0 for none')
+    parser.add_argument('--startup-runs', type=int, default=5, help='new processes to time starting up in, 0 for none')
+    parser.add_argument('--startup-target', type=float, default=STARTUP_TARGET,
+                        help='milliseconds loading and setting up may take')
+    args = parser.parse_args(argv)
+
+    if not settings.configured and not os.environ.get(ENVIRONMENT_VARIABLE):
+        # run on its own, the stand-ins need nothing from the settings
+        settings.configure()
+    status = 0
+    benchmarks = [b for b in default_benchmarks() if args.filter is None or args.filter in b.name]
+    report = run_benchmarks(benchmarks, args.iterations, args.latency, args.jitter, args.failure_rate, args.seed,
+                            out=sys.stdout)
+    if args.overhead_iterations and (args.filter is None or args.filter in 'overhead'):
+        overhead = run_overhead(args.overhead_iterations)
+        for name in sorted(name for name in overhead if name.endswith('/cacheandra')):
+            op = name.rsplit('/', 1)[0]
+            extra = overhead[name]['mean'] - overhead[op + '/plain']['mean']
+            sys.stdout.write('%-70s mean %8.3fms  %+8.1fus a call\n' % (op, overhead[name]['mean'], extra * 1000))
+        report.update(overhead)
+    if args.startup_runs and (args.filter is None or args.filter in 'startup'):
+        startup = run_startup(args.startup_runs)
+        for name, result in sorted(startup.items()):
+            sys.stdout.write('%-70s p50 %8.3fms  p99 %8.3fms\n' % (name, result['p50'], result['p99']))
+        report.update(startup)
+        took = startup['startup/import']['p50'] + startup['startup/setup']['p50']
+        if took > args.startup_target:
+            sys.stdout.write('startup took %.1fms, over the target of %.1fms\n' % (took, args.startup_target))
+            status = 1
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            before = json.load(f)
+        if compare(before, report, args.threshold):
+            status = 1
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,54 +2,349 @@
 Cacheandra backend
 """
 
+import os
+import re
 import time
-from threading import local
+from threading import Lock, Thread, local
 
 from django.core.cache.backends.base import BaseCache, InvalidCacheBackendError
 from django.utils import importlib
 
-import pylibmc, _pylibmc
 import logging
 
-import cPickle as pickle
+from .concurrency import get_executor, get_refresher, get_single_flight
+from .generations import get_generations
+from .hotkeys import get_hot_keys
+from .keys import KeyTransform, key_distribution, token_ring
+from .lazy import LazyModule
+from .localcache import get_local_cache
+from .metrics import get_metrics
+from .policies import RetryPolicy, get_circuit_breaker
+from .serializers import Serializer
+from .writebehind import get_counter_aggregator, get_write_behind_queue
 
 logger = logging.getLogger(__name__)
 
+"""
+pylibmc and pycassa are imported when they're first used rather than when the backend is loaded, which keeps
+starting up a worker - and setting up a cache that turns out not to need one of them - quick
+"""
+
+pylibmc = LazyModule('pylibmc')
+_pylibmc = LazyModule('_pylibmc')
+pycassa = LazyModule('pycassa')
+pycassa_ttypes = LazyModule('pycassa.cassandra.ttypes')
+pycassa_pool = LazyModule('pycassa.pool')
+pycassa_batch = LazyModule('pycassa.batch')
+
 """
 This is extended from the default django backend to handle individual cache server failures in a cluster
 pylibmc doesn't do a good job of returning sensible error values here, so we do the mapping here
 """
 
 ERROR_UNKNOWN = -1
-MEMCACHED_ERROR_SERVER_DISABLED_UNTIL_TIMED_RETRY = 47
+MEMCACHED_ERROR_CONNECTION_FAILURE = 3
+MEMCACHED_ERROR_TIMEOUT = 31
 MEMCACHED_ERROR_SERVER_IS_DEAD = 35
+MEMCACHED_ERROR_SERVER_DISABLED_UNTIL_TIMED_RETRY = 47
+
+# errors that mean a server couldn't be reached, rather than that it didn't like the request
+MEMCACHED_CONNECTION_ERRORS = (MEMCACHED_ERROR_CONNECTION_FAILURE, MEMCACHED_ERROR_TIMEOUT,
+                               MEMCACHED_ERROR_SERVER_IS_DEAD, MEMCACHED_ERROR_SERVER_DISABLED_UNTIL_TIMED_RETRY)
 
-import inspect
+# errors where the client didn't send the request, because it has given up on the server for now
+MEMCACHED_NOT_SENT_ERRORS = (MEMCACHED_ERROR_SERVER_IS_DEAD, MEMCACHED_ERROR_SERVER_DISABLED_UNTIL_TIMED_RETRY)
 
-def lineno():
-    """Returns the current line number in our program."""
-    return inspect.currentframe().f_back.f_lineno
+# calls that give the same result if they're made twice. After a timeout or a dropped connection the server may
+# have made the call anyway, so the others (incr, decr, add) are only retried when it wasn't sent
+MEMCACHED_IDEMPOTENT_CALLS = frozenset(['get', 'get_multi', 'set', 'set_multi', 'delete', 'delete_multi'])
 
+# pylibmc's messages look like 'error 47 from memcached_get(:1:key): (0x...) SERVER HAS FAILED...'
+_memcached_error_number = re.compile(r'error (\d+) from')
 
 """
 Global cassandra stuff
 """
 
-import pycassa
-from pycassa import NotFoundException, InvalidRequestException, UnavailableException, TimedOutException
-from pycassa.cassandra.ttypes import AuthenticationException, AuthorizationException, SchemaDisagreementException
-from pycassa.pool import AllServersUnavailable, NoConnectionAvailable, MaximumRetryException
+# the OPTIONS the connection pool and column families are made with
+CONNECTION_OPTIONS = ('pool_size', 'pool_max_overflow', 'pool_timeout', 'pool_prefill', 'pool_recycle',
+                      'cassandra_timeout', 'cassandra_max_retries', 'read_consistency', 'write_consistency')
+
+def connection_errors():
+    # what creating a connection pool can raise - a function so that pycassa isn't imported until it's needed
+    return (pycassa.InvalidRequestException, pycassa.UnavailableException, pycassa.TimedOutException,
+            pycassa_ttypes.AuthenticationException, pycassa_ttypes.AuthorizationException,
+            pycassa_ttypes.SchemaDisagreementException, pycassa_pool.AllServersUnavailable,
+            pycassa_pool.NoConnectionAvailable, pycassa_pool.MaximumRetryException, pycassa.NotFoundException)
+
+"""
+Connection pools and column families, one set per process for each cassandra cluster, keyspace and column family
+shared by every CacheBackend using them. If connecting fails it's tried again on use, at most every
+pool_retry_interval seconds.
+"""
+
+_connections = {}
+_connect_failures = {}
+_connections_lock = Lock()
+_background_connects = set()
+# the partitioner cassandra said it uses, by connection
+_partitioners = {}
+
+"""
+Tier hints for get, set, get_many and set_many
+
+both           - the default, read through memcached to cassandra and write to both
+memcached_only - for hot, short lived data - never read from or written to cassandra. A key should always be
+                 written this way, or an older value in cassandra may be read after memcached has dropped it
+cassandra_only - for large values not worth the room in memcached - read from cassandra without filling
+                 memcached, and written to cassandra while removing any copy in memcached
+"""
+
+TIER_BOTH = 'both'
+TIER_MEMCACHED_ONLY = 'memcached_only'
+TIER_CASSANDRA_ONLY = 'cassandra_only'
+
+"""
+Consistency levels that can be used in read_consistency and write_consistency - names in pycassa.ConsistencyLevel
+"""
+
+CONSISTENCY_LEVELS = ('ANY', 'ONE', 'TWO', 'THREE', 'QUORUM', 'LOCAL_QUORUM', 'EACH_QUORUM', 'ALL')
+
+"""
+Soft timeouts
+
+get_or_set stores its values wrapped in a SoftValue, which goes stale some time before the value expires from
+memcached and cassandra. A stale value is still returned while a fresh one is worked out in the background.
+"""
+
+REFRESH_SUFFIX = ':refresh'
+
+class SoftValue(object):
+    def __init__(self, value, soft_expiry):
+        self.value = value
+        self.soft_expiry = soft_expiry
+
+"""
+Generations
+
+With generations on, every key carries the cache's generation number, and the generation of its namespace if the
+part of the key before generation_separator is one of generation_namespaces. clear() and clear_prefix(namespace)
+move a generation on rather than removing anything, and what was written under the old one ages out with its timeout.
+Generations are kept in the counter column family, copied into memcached, and remembered in each process for
+generation_timeout seconds - so for that long after a clear other processes may still see the old values.
+"""
+
+GENERATION_KEY = 'cacheandra-generation'
+
+"""
+When to connect to cassandra
+
+lazy       - on first use, so setting up the cache never waits for cassandra
+eager      - when the cache is set up, so that a cassandra problem shows up straight away
+background - straight away, on a thread of its own, so the connection is usually ready by first use
+"""
+
+CONNECT_LAZY = 'lazy'
+CONNECT_EAGER = 'eager'
+CONNECT_BACKGROUND = 'background'
 
 def parseMemcachedError(exception):
-    if type(exception) != _pylibmc.MemcachedError:
-        return ERROR_UNKNOWN
-    if len(exception.args) < 1:
-        return ERROR_UNKNOWN
-    if exception.args[0] == 'error 47 from memcached_set: SERVER HAS FAILED AND IS DISABLED UNTIL TIMED RETRY':
+    if isinstance(exception, _pylibmc.ServerDown):
         return MEMCACHED_ERROR_SERVER_DISABLED_UNTIL_TIMED_RETRY
-    if exception.args[0] == 'error 35 from memcached_set: SERVER IS MARKED DEAD':
+    if isinstance(exception, _pylibmc.ServerDead):
         return MEMCACHED_ERROR_SERVER_IS_DEAD
-    return ERROR_UNKNOWN
+    if isinstance(exception, _pylibmc.ConnectionError):
+        return MEMCACHED_ERROR_CONNECTION_FAILURE
+    if len(exception.args) < 1 or not isinstance(exception.args[0], basestring):
+        return ERROR_UNKNOWN
+    match = _memcached_error_number.match(exception.args[0])
+    if match is None:
+        return ERROR_UNKNOWN
+    return int(match.group(1))
+
+"""
+Cassandra storage layouts
+
+split  - counters live in the counter column family, everything else in the value column family. A miss
+         reads the counter column family first and then the value column family, two round trips.
+tagged - as split, but the value row of a counter also carries a COUNTER_TAG_COLUMN marker, so a single
+         read of the value row says whether there's a value, a counter, or nothing at all.
+         Existing data needs migrate_to_tagged_layout() running over it once.
+"""
+
+LAYOUT_SPLIT = 'split'
+LAYOUT_TAGGED = 'tagged'
+COUNTER_TAG_COLUMN = 'ctr'
+
+# the absolute time a value expires from cassandra, '0' if it never does
+EXPIRY_COLUMN = 'exp'
+
+# a value bigger than large_value_threshold is stored in columns chunk:000000, chunk:000001... and its val is
+# CHUNKED_HEADER followed by the number of chunks. No serialized value starts with a 0 byte.
+CHUNKED_HEADER = '\x00chunks:'
+CHUNK_PREFIX = 'chunk:'
+
+def _chunk_column(n):
+    return CHUNK_PREFIX + '%06d' % n
+
+def _is_chunked(columns):
+    return columns['val'].startswith(CHUNKED_HEADER)
+
+"""
+Counter modes
+
+exact - incr/decr read the counter back from cassandra after changing it, and return that
+fast  - when memcached has answered incr/decr its value is returned, and cassandra is sent the change and the
+        removal of the out of date val in one batch without reading anything back
+"""
+
+COUNTER_MODE_EXACT = 'exact'
+COUNTER_MODE_FAST = 'fast'
+
+# memcached key suffix for the lease taken by the process reading a key through from cassandra
+LEASE_SUFFIX = ':lease'
+
+# stored in memcached (and the in-process cache) under a key cassandra has confirmed isn't there, so the next
+# get doesn't ask cassandra again. set and set_many overwrite it, add replaces it and delete removes it.
+MISS_MARKER = '\x00cacheandra:miss\x00'
+
+def _is_miss(val):
+    return val.__class__ is str and val == MISS_MARKER
+
+# stored in memcached in place of a value too large for it, which is only in cassandra - so add sees that the
+# key is taken, and get goes straight to cassandra for it
+LARGE_MARKER = '\x00cacheandra:large\x00'
+
+def _is_large(val):
+    return val.__class__ is str and val == LARGE_MARKER
+
+# get_many puts values back into memcached in groups with the same timeout, rounded down to this many seconds
+BACKFILL_TIMEOUT_GRANULARITY = 60
+
+"""
+OPTIONS used by cacheandra itself, with their defaults. Anything else in OPTIONS is handed to pylibmc
+as client behaviors.
+"""
+
+CACHEANDRA_OPTIONS = {
+    'layout': LAYOUT_SPLIT,
+    # in-process tier in front of memcached, off unless l0_max_entries is set
+    'l0_max_entries': 0,
+    'l0_max_bytes': 16*1024*1024,
+    'l0_timeout': 5,
+    # only hold these keys in the in-process tier - with a short l0_timeout this soaks up the reads on hot keys
+    'l0_hot_keys': None,
+    # only one thread per process reads a key through from cassandra at a time, the rest wait for it
+    'coalesce_reads': True,
+    # seconds a process holds a memcached lease while it reads a key through from cassandra, 0 for no lease.
+    # other processes wait for the value to turn up in memcached rather than reading cassandra themselves
+    'coalesce_lease_timeout': 0,
+    'coalesce_lease_poll': 0.02,
+    # seconds to remember that cassandra has confirmed a key isn't there, 0 to not remember.
+    # with negative_l0 the in-process cache remembers it too, for at most l0_timeout
+    'negative_timeout': 0,
+    'negative_l0': False,
+    # memcached calls that couldn't reach their server are retried at most retry_max_attempts times in all, with
+    # a jittered backoff from retry_delay up to retry_max_delay, and never past retry_deadline seconds. incr, decr
+    # and add are only retried if they weren't sent, a timeout could mean they were made
+    'retry_max_attempts': 3,
+    'retry_delay': 0.05,
+    'retry_max_delay': 0.2,
+    'retry_deadline': 0.5,
+    # after breaker_threshold calls in a row fail memcached is left alone for breaker_reset_timeout seconds
+    'breaker_threshold': 5,
+    'breaker_reset_timeout': 5,
+    # how values are stored in cassandra - 'pickle', 'marshal' or 'msgpack', compressed with 'zlib' or 'lz4'
+    # once they are at least min_compress_len bytes. 0 leaves everything uncompressed.
+    'serializer': 'pickle',
+    'compression': 'zlib',
+    'min_compress_len': 0,
+    'compress_level': 6,
+    # values that are more than large_value_threshold bytes once serialized (0 for no limit) are kept out of
+    # memcached, and stored in cassandra in chunks of large_value_chunk_size bytes
+    'large_value_threshold': 0,
+    'large_value_chunk_size': 256*1024,
+    # with memcached and cassandra, write to cassandra from a queue in the background instead of on the request.
+    # the queue holds at most write_behind_max_size keys, when it's full a write waits write_behind_put_timeout
+    # seconds for room before making the write itself. close() waits at most write_behind_close_timeout seconds
+    # for the queue to drain and leaves the rest queued, flush() and process exit wait for all of it
+    'write_behind': False,
+    'write_behind_max_size': 10000,
+    'write_behind_workers': 2,
+    'write_behind_batch_size': 100,
+    'write_behind_put_timeout': 0.05,
+    'write_behind_close_timeout': 0.1,
+    # get_many reads cassandra in chunks of this many keys, concurrently on a pool of executor_size threads
+    # per process, waiting at most get_many_timeout seconds for them - keys in chunks that don't make it miss
+    'get_many_chunk_size': 100,
+    'get_many_timeout': 1.0,
+    'executor_size': 8,
+    # how many keys go in each cassandra batch of delete_many, the batches are sent concurrently
+    'delete_batch_size': 100,
+    # the cassandra connection pool
+    'pool_size': 5,
+    'pool_max_overflow': 0,
+    'pool_timeout': 30,
+    'pool_prefill': True,
+    'pool_recycle': 10000,
+    'pool_retry_interval': 5,
+    'cassandra_timeout': 0.5,
+    'cassandra_max_retries': 2,
+    'cassandra_connect': CONNECT_LAZY,
+    # the keyspace is a cache with a replication factor of 1, so there's nothing to gain from more than ONE
+    'read_consistency': 'ONE',
+    'write_consistency': 'ONE',
+    # the class name of the cluster's partitioner, which warming and key_distribution cut the token ring up by -
+    # None asks cassandra
+    'partitioner': None,
+    # see the counter modes above. In fast mode counter_flush_interval sums the changes to each counter in the
+    # process and sends them to cassandra every that many milliseconds, 0 sends every change straight away
+    'counter_mode': COUNTER_MODE_EXACT,
+    'counter_flush_interval': 0,
+    # keys used in memcached and cassandra are key_namespace:key, and keys longer than key_hash_threshold
+    # (0 for never) are replaced by their key_hash digest - see keys.KeyTransform
+    'key_namespace': None,
+    'key_hash_threshold': 0,
+    'key_hash': 'md5',
+    # with generations clear() moves a generation number on rather than truncating, and the keys starting with
+    # one of generation_namespaces and generation_separator have a generation of their own for clear_prefix
+    'generations': False,
+    'generation_namespaces': (),
+    'generation_separator': ':',
+    'generation_timeout': 5,
+    # threads per process running the calls of AsyncCacheClient
+    'async_pool_size': 32,
+    # values set by get_or_set go stale after soft_timeout_ratio of their timeout, and are then refreshed on a
+    # pool of refresh_pool_size threads per process, by one process at a time for at most refresh_lock_timeout
+    'soft_timeout_ratio': 0.8,
+    'refresh_pool_size': 4,
+    'refresh_lock_timeout': 30,
+    # a key read about hot_key_threshold times in hot_key_window seconds - counting hot_key_sample_rate of the
+    # reads in a hot_key_sketch_width by hot_key_sketch_depth count-min sketch - is copied to hot_key_replicas
+    # more keys in memcached, and reads of it are spread across them. 0 copies turns this off. At most
+    # hot_key_max keys are hot at once, and copies last at most hot_key_replica_timeout seconds
+    'hot_key_replicas': 0,
+    'hot_key_threshold': 1000,
+    'hot_key_window': 10,
+    'hot_key_sample_rate': 0.1,
+    'hot_key_max': 100,
+    'hot_key_replica_timeout': 10,
+    'hot_key_sketch_width': 4096,
+    'hot_key_sketch_depth': 4,
+    # where counts and latencies go - None for nowhere, 'memory' (see metrics_snapshot), 'statsd', 'signal',
+    # or the dotted path of a metrics.Metrics subclass
+    'metrics': None,
+    'statsd_host': '127.0.0.1',
+    'statsd_port': 8125,
+    'metrics_prefix': 'cacheandra',
+}
+
+# the operations timed when metrics are on
+INSTRUMENTED_OPERATIONS = ('add', 'get', 'set', 'delete', 'get_many', 'set_many', 'delete_many', 'incr', 'decr')
+
+# with only memcached, and no in-process tier or hot key copies, each of these operations is made by
+# _memcached_only_<operation> instead - which leaves out everything to do with cassandra
+MEMCACHED_ONLY_OPERATIONS = INSTRUMENTED_OPERATIONS
 
 def timeout_to_ttl(timeout):
     if timeout==0 or timeout<0:
@@ -72,45 +367,322 @@ class CacheBackend(BaseCache):
         else:
             self._memcached_available=True
         self._local = local()
-        self.timeoutretrydelay = 0.2
-        
-        self._options = params.get('OPTIONS', None)
         
+        options = dict(params.get('OPTIONS', None) or {})
+        self._cacheandra_options = dict((name, options.pop(name, default)) for name, default in CACHEANDRA_OPTIONS.items())
+        self._options = options or None
+
+        self._layout = self._cacheandra_options['layout']
+        if self._layout not in (LAYOUT_SPLIT, LAYOUT_TAGGED):
+            raise InvalidCacheBackendError("Cacheandra: unknown layout %r" % self._layout)
+
+        self._metrics = get_metrics(self._cacheandra_options['metrics'], self._cacheandra_options)
+
+        self._counter_mode = self._cacheandra_options['counter_mode']
+        if self._counter_mode not in (COUNTER_MODE_EXACT, COUNTER_MODE_FAST):
+            raise InvalidCacheBackendError("Cacheandra: unknown counter mode %r" % self._counter_mode)
+
+        try:
+            self._serializer = Serializer(self._cacheandra_options['serializer'],
+                                          self._cacheandra_options['compression'],
+                                          self._cacheandra_options['min_compress_len'],
+                                          self._cacheandra_options['compress_level'])
+        except ValueError as e:
+            raise InvalidCacheBackendError("Cacheandra: %s" % e)
+
+        self._key_transform = None
+        if self._cacheandra_options['key_namespace'] or self._cacheandra_options['key_hash_threshold']:
+            try:
+                self._key_transform = KeyTransform(self._cacheandra_options['key_namespace'],
+                                                   self._cacheandra_options['key_hash_threshold'],
+                                                   self._cacheandra_options['key_hash'])
+            except ValueError as e:
+                raise InvalidCacheBackendError("Cacheandra: %s" % e)
+
         self._cassandra_servers = params.get('CASSANDRA',None)
+        if isinstance(self._cassandra_servers, basestring):
+            self._cassandra_servers = self._cassandra_servers.split(';')
         self._keyspace = params.get('KEYSPACE','cacheandra')
         self._columnfamilyname = params.get('COLUMNFAMILY','cache')
-        self._cf=None
-        self._countercf=None
+        self._connection = None
+
+        # per process state is shared between the backends for the same location
+        self._location = repr((self._servers, self._cassandra_servers, self._keyspace, self._columnfamilyname))
+
+        self._generations = None
+        self._generation_namespaces = frozenset(self._cacheandra_options['generation_namespaces'])
+        if self._cacheandra_options['generations']:
+            self._generations = get_generations(self._location, self._cacheandra_options['generation_timeout'],
+                                                tuple(sorted(self._generation_namespaces)))
+        self._generation_separator = self._cacheandra_options['generation_separator']
 
+        self._l0 = None
+        if self._cacheandra_options['l0_max_entries']:
+            self._l0 = get_local_cache(self._location,
+                                       self._cacheandra_options['l0_max_entries'],
+                                       self._cacheandra_options['l0_max_bytes'])
+        self._l0_timeout = self._cacheandra_options['l0_timeout']
+        hot_keys = self._cacheandra_options['l0_hot_keys']
+        self._l0_hot_keys = frozenset(hot_keys) if hot_keys is not None else None
+
+        self._single_flight = None
+        if self._cacheandra_options['coalesce_reads']:
+            self._single_flight = get_single_flight(self._location)
+        self._lease_timeout = self._cacheandra_options['coalesce_lease_timeout']
+        self._lease_poll = self._cacheandra_options['coalesce_lease_poll']
+        self._negative_timeout = self._cacheandra_options['negative_timeout']
+        self._negative_l0 = self._cacheandra_options['negative_l0'] and self._negative_timeout and self._l0 is not None
+
+        self._large_value_threshold = self._cacheandra_options['large_value_threshold']
+        self._chunk_size = self._cacheandra_options['large_value_chunk_size']
+
+        self._hot_keys = None
+        if self._cacheandra_options['hot_key_replicas'] and self._memcached_available:
+            self._hot_keys = get_hot_keys(self._location,
+                                          self._cacheandra_options['hot_key_replicas'],
+                                          self._cacheandra_options['hot_key_threshold'],
+                                          self._cacheandra_options['hot_key_window'],
+                                          self._cacheandra_options['hot_key_sample_rate'],
+                                          self._cacheandra_options['hot_key_max'],
+                                          self._cacheandra_options['hot_key_sketch_width'],
+                                          self._cacheandra_options['hot_key_sketch_depth'])
+        self._hot_key_replica_timeout = self._cacheandra_options['hot_key_replica_timeout']
+
+        self._compute_flight = get_single_flight(self._location + REFRESH_SUFFIX)
+        self._refresher = get_refresher(self._location, self._cacheandra_options['refresh_pool_size'])
+
+        self._retry_policy = RetryPolicy(self._cacheandra_options['retry_max_attempts'],
+                                         self._cacheandra_options['retry_delay'],
+                                         self._cacheandra_options['retry_max_delay'],
+                                         self._cacheandra_options['retry_deadline'])
+        self._breaker = get_circuit_breaker(repr(self._servers),
+                                            self._cacheandra_options['breaker_threshold'],
+                                            self._cacheandra_options['breaker_reset_timeout'])
+
+        self._write_behind = None
+        if self._cacheandra_options['write_behind'] and self._memcached_available and self._cassandra_servers is not None:
+            self._write_behind = get_write_behind_queue(self._location,
+                                                        max_size=self._cacheandra_options['write_behind_max_size'],
+                                                        workers=self._cacheandra_options['write_behind_workers'],
+                                                        batch_size=self._cacheandra_options['write_behind_batch_size'],
+                                                        put_timeout=self._cacheandra_options['write_behind_put_timeout'])
+
+        self._counters = None
+        if (self._counter_mode == COUNTER_MODE_FAST and self._cacheandra_options['counter_flush_interval'] and
+                self._memcached_available and self._cassandra_servers is not None):
+            self._counters = get_counter_aggregator(self._location,
+                                                    self._cacheandra_options['counter_flush_interval'] / 1000.0)
+
+        for option in ('read_consistency', 'write_consistency'):
+            if self._cacheandra_options[option] not in CONSISTENCY_LEVELS:
+                raise InvalidCacheBackendError("Cacheandra: unknown %s %r" % (option, self._cacheandra_options[option]))
+
+        connect = self._cacheandra_options['cassandra_connect']
+        if connect not in (CONNECT_LAZY, CONNECT_EAGER, CONNECT_BACKGROUND):
+            raise InvalidCacheBackendError("Cacheandra: unknown cassandra_connect %r" % connect)
         if self._cassandra_servers is not None:
+            if connect == CONNECT_EAGER:
+                self._connect()
+            elif connect == CONNECT_BACKGROUND:
+                self._connect_in_background()
+
+        self._memcached_only = (self._cassandra_servers is None and self._memcached_available and
+                               self._l0 is None and self._hot_keys is None)
+        if self._memcached_only:
+            for name in MEMCACHED_ONLY_OPERATIONS:
+                setattr(self, name, getattr(self, '_memcached_only_' + name))
+
+        if self._metrics.enabled:
+            # with metrics off the operations aren't wrapped at all, so there's nothing to pay for them
+            for name in INSTRUMENTED_OPERATIONS:
+                setattr(self, name, self._metrics.timed(name, getattr(self, name)))
+
+    def make_key(self, key, version=None):
+        if self._generations is not None:
+            key = self._generation_tag(key) + key
+        key = super(CacheBackend, self).make_key(key, version=version)
+        if self._key_transform is not None:
+            key = self._key_transform(key)
+        return key
+
+    def _generation_tag(self, key):
+        generation = self._generations.get(None, self._load_generation)
+        i = key.find(self._generation_separator)
+        if i > 0 and key[:i] in self._generation_namespaces:
+            return 'g%d.%d:' % (generation, self._generations.get(key[:i], self._load_generation))
+        return 'g%d:' % generation
+
+    def _generation_key(self, name):
+        # None is the generation of the whole cache
+        key = '%s%s' % (self.key_prefix, GENERATION_KEY)
+        if name is not None:
+            key += ':' + name
+        if self._key_transform is not None:
+            key = self._key_transform(key)
+        return key
+
+    def _load_generation(self, name):
+        """
+        The generation called name from memcached, or cassandra if memcached doesn't have it - None if neither
+        can be asked
+        """
+        key = self._generation_key(name)
+        memcached_ok = False
+        if self._memcached_available:
+            memcached_ok, generation = self._memcached(self._cache.get, key)
+            if generation is not None:
+                return generation
+        if self._countercf is not None:
             try:
-                self._pool = pycassa.ConnectionPool(keyspace=self._keyspace,
-                                                   server_list = self._cassandra_servers,
-                                                   pool_size = len(self._cassandra_servers),
-                                                   timeout=0.5,
-                                                   max_retries=2)
-
-            except (InvalidRequestException, UnavailableException, TimedOutException, AuthenticationException,
-                    AuthorizationException, SchemaDisagreementException, AllServersUnavailable, NoConnectionAvailable,
-                    MaximumRetryException) as e:
-                logger.exception('Cacheandra: failed on connection pool creation %r', e)
-                self._pool = None
-        
-            if self._pool is not None:
+                generation = self._countercf.get(key,columns=['count'])['count']
+            except pycassa.NotFoundException:
+                generation = 0
+            except Exception as e:
+                self._cassandra_error("Cacheandra failed to get generation %r", e)
+                return None
+        elif memcached_ok:
+            # with nothing else to remember it, a generation memcached has lost starts again from the time,
+            # so it never goes back to one that has been used
+            generation = int(time.time())
+        else:
+            return None
+        if self._memcached_available:
+            memcached_ok, added = self._memcached(self._cache.add, key, generation, 0)
+            if memcached_ok and not added:
+                # another process got there first
+                memcached_ok, current = self._memcached(self._cache.get, key)
+                if current is not None:
+                    generation = current
+        return generation
+
+    def _next_generation(self, name):
+        key = self._generation_key(name)
+        generation = None
+        if self._countercf is not None:
+            try:
+                self._countercf.add(key,'count',1)
+                generation = self._countercf.get(key,columns=['count'])['count']
+            except Exception as e:
+                self._cassandra_error("Cacheandra failed to change generation %r", e)
+        if self._memcached_available:
+            if generation is not None:
+                self._memcached(self._cache.set, key, generation, 0)
+            else:
+                try:
+                    memcached_ok, generation = self._memcached(self._cache.incr, key, 1)
+                except pylibmc.NotFound:
+                    generation = int(time.time())
+                    self._memcached(self._cache.set, key, generation, 0)
+        if generation is not None:
+            self._generations.set(name, generation)
+        return generation
+
+    def key_distribution(self, keys, version=None, ranges=16):
+        """
+        How keys would spread over the memcached servers and ranges slices of the cassandra token ring -
+        see keys.key_distribution
+        """
+        servers = self._servers if self._memcached_available else None
+        if self._cassandra_servers is None:
+            ranges = 0
+        return key_distribution([self.make_key(key, version=version) for key in keys], servers, ranges,
+                                self.partitioner() if ranges else None)
+
+    def partitioner(self):
+        """
+        The class name of the cassandra cluster's partitioner - the partitioner option, or else what cassandra
+        says, asked once per process. ValueError if token ranges can't be worked out for it, or cassandra
+        can't be reached to ask.
+        """
+        partitioner = self._cacheandra_options['partitioner']
+        if partitioner is None:
+            key = self._connection_key()
+            partitioner = _partitioners.get(key)
+            if partitioner is None:
+                cf = self._cf
+                if cf is None:
+                    raise ValueError("Cacheandra: can't ask cassandra for its partitioner, set the partitioner option")
+                connection = cf.pool.get()
+                try:
+                    partitioner = connection.describe_partitioner()
+                finally:
+                    connection.return_to_pool()
+                _partitioners[key] = partitioner
+        token_ring(partitioner)
+        return partitioner
+
+    def _connect(self):
+        """
+        Returns this process's (value, counter) column families, connecting to cassandra if that hasn't been
+        done yet - or (None, None) if there's no cassandra, or connecting has failed too recently to try again.
+        """
+        connection = self._connection
+        if connection is not None and connection[0] == os.getpid():
+            return connection[1], connection[2]
+        if self._cassandra_servers is None:
+            return None, None
+
+        key = self._connection_key()
+        retry_interval = self._cacheandra_options['pool_retry_interval']
+        if time.time() - _connect_failures.get(key, 0) < retry_interval:
+            return None, None
+        with _connections_lock:
+            connection = _connections.get(key)
+            if connection is None:
+                if time.time() - _connect_failures.get(key, 0) < retry_interval:
+                    return None, None
+                read_consistency = getattr(pycassa.ConsistencyLevel, self._cacheandra_options['read_consistency'])
+                write_consistency = getattr(pycassa.ConsistencyLevel, self._cacheandra_options['write_consistency'])
                 try:
-                    self._cf = pycassa.ColumnFamily(self._pool,self._columnfamilyname,
-                                                    write_consistency_level=pycassa.ConsistencyLevel.ONE,
-                                                    read_consistency_level=pycassa.ConsistencyLevel.QUORUM)
-                    self._countercf = pycassa.ColumnFamily(self._pool,self._columnfamilyname+'_counter',
-                                                    default_column_validators=pycassa.types.CounterColumnType(),
-                                                    write_consistency_level=pycassa.ConsistencyLevel.ONE,
-                                                    read_consistency_level=pycassa.ConsistencyLevel.QUORUM)
-                except (InvalidRequestException, UnavailableException, TimedOutException, AuthenticationException,
-                        AuthorizationException, SchemaDisagreementException, AllServersUnavailable, NoConnectionAvailable,
-                        MaximumRetryException, NotFoundException) as e:
-                    self._cf = None
-                    self._countercf=None
-                
+                    pool = pycassa.ConnectionPool(keyspace=self._keyspace,
+                                                  server_list=self._cassandra_servers,
+                                                  pool_size=self._cacheandra_options['pool_size'],
+                                                  max_overflow=self._cacheandra_options['pool_max_overflow'],
+                                                  pool_timeout=self._cacheandra_options['pool_timeout'],
+                                                  prefill=self._cacheandra_options['pool_prefill'],
+                                                  recycle=self._cacheandra_options['pool_recycle'],
+                                                  timeout=self._cacheandra_options['cassandra_timeout'],
+                                                  max_retries=self._cacheandra_options['cassandra_max_retries'])
+                    cf = pycassa.ColumnFamily(pool,self._columnfamilyname,
+                                              write_consistency_level=write_consistency,
+                                              read_consistency_level=read_consistency)
+                    countercf = pycassa.ColumnFamily(pool,self._columnfamilyname+'_counter',
+                                                     default_column_validators=pycassa.types.CounterColumnType(),
+                                                     write_consistency_level=write_consistency,
+                                                     read_consistency_level=read_consistency)
+                except connection_errors() as e:
+                    logger.exception('Cacheandra: failed on connection pool creation %r', e)
+                    _connect_failures[key] = time.time()
+                    return None, None
+                connection = (os.getpid(), cf, countercf)
+                _connections[key] = connection
+        self._connection = connection
+        return connection[1], connection[2]
+
+    def _connection_key(self):
+        # backends that would make different pools or column families mustn't share them
+        options = tuple(self._cacheandra_options[name] for name in CONNECTION_OPTIONS)
+        return (tuple(self._cassandra_servers), self._keyspace, self._columnfamilyname, options, os.getpid())
+
+    def _connect_in_background(self):
+        # one thread per process per connection, however many backends are set up for it
+        key = self._connection_key()
+        with _connections_lock:
+            if key in _connections or key in _background_connects:
+                return
+            _background_connects.add(key)
+        t = Thread(target=self._connect, name='cacheandra-connect')
+        t.daemon = True
+        t.start()
+
+    @property
+    def _cf(self):
+        return self._connect()[0]
+
+    @property
+    def _countercf(self):
+        return self._connect()[1]
+
     @property
     def _cache(self):
         # PylibMC uses cache options as the 'behaviors' attribute.
@@ -144,363 +716,1204 @@ class CacheBackend(BaseCache):
             timeout += int(time.time())
         return timeout
 
-    def add(self, akey, value, timeout=0, version=None):
-        key = self.make_key(akey, version=version)
-        rv = None
-        if self._memcached_available:
+    def _memcached(self, func, *args):
+        """
+        Calls func(*args) on the memcached client under the retry policy and circuit breaker.
+        Returns (True, result) if memcached answered, or (False, None) if it couldn't be used - in which
+        case carry on as if memcached had missed. pylibmc.NotFound is raised to the caller. A call that isn't
+        in MEMCACHED_IDEMPOTENT_CALLS fails without a retry if it may have reached the server.
+        """
+        if not self._breaker.allow():
+            self._metrics.incr('memcached.unavailable')
+            return False, None
+        delays = None
+        while True:
             try:
-                rv = self._cache.add(key, value, self._get_memcache_timeout(timeout))
+                if self._metrics.enabled:
+                    start = time.time()
+                    result = func(*args)
+                    self._metrics.timing('memcached.' + func.__name__, time.time() - start)
+                else:
+                    result = func(*args)
+            except pylibmc.NotFound:
+                self._breaker.success()
+                raise
             except _pylibmc.MemcachedError as error:
                 error_num = parseMemcachedError(error)
-                if error_num == MEMCACHED_ERROR_SERVER_DISABLED_UNTIL_TIMED_RETRY:
-                    # the server will either come back to life, or die, so we try again
-                    logger.info("MEMCACHED_ERROR_SERVER_DISABLED_UNTIL_TIMED_RETRY on add %s" % akey)
-                    time.sleep(self.timeoutretrydelay)
-                    rv = self.add(akey, value, timeout, version)
-                elif error_num == MEMCACHED_ERROR_SERVER_IS_DEAD:
-                    # next attempt should succeed, if not return the failure
-                    rv = self._cache.add(key, value, self._get_memcache_timeout(timeout))
+                if error_num not in MEMCACHED_CONNECTION_ERRORS:
+                    # the server answered, it just didn't like the request
+                    self._breaker.success()
+                    self._metrics.incr('memcached.error.' + error.__class__.__name__)
+                    logger.warning("Cacheandra memcached %s failed %r", func.__name__, error)
+                    return False, None
+                if error_num not in MEMCACHED_NOT_SENT_ERRORS and func.__name__ not in MEMCACHED_IDEMPOTENT_CALLS:
+                    # the server may have made it already, so making it again could make it twice
+                    delay = None
                 else:
-                    rv = False
+                    if delays is None:
+                        delays = self._retry_policy.delays()
+                    delay = next(delays, None)
+                if delay is None:
+                    self._breaker.failure()
+                    self._metrics.incr('memcached.unavailable')
+                    return False, None
+                self._metrics.incr('memcached.retry')
+                if error_num != MEMCACHED_ERROR_SERVER_IS_DEAD:
+                    # the server will either come back to life, or die, so we try again
+                    time.sleep(delay)
+                # a server marked dead has been taken out of the ring, so the next attempt should go elsewhere
+            else:
+                self._breaker.success()
+                return True, result
+
+    def _cassandra_error(self, message, e):
+        self._metrics.incr('cassandra.error.' + e.__class__.__name__)
+        logger.exception(message, e)
+
+    def metrics_snapshot(self):
+        """
+        The counts and latencies collected so far, if the metrics sink keeps them - see metrics.MemoryMetrics
+        """
+        return self._metrics.snapshot()
+
+    def _tiers(self, tier):
+        """
+        Whether a call with the tier hint tier should use memcached and cassandra
+        """
+        if tier is None or tier == TIER_BOTH:
+            return self._memcached_available, True
+        if tier == TIER_MEMCACHED_ONLY:
+            return self._memcached_available, False
+        if tier == TIER_CASSANDRA_ONLY:
+            return False, True
+        raise ValueError("Cacheandra: unknown tier %r" % tier)
+
+    def _l0_wanted(self, akey):
+        return self._l0 is not None and (self._l0_hot_keys is None or akey in self._l0_hot_keys)
+
+    def local_cache_stats(self):
+        """
+        Hits, misses, entries and bytes of the in-process tier, or None if it isn't enabled
+        """
+        if self._l0 is None:
+            return None
+        return self._l0.stats()
+
+    def hot_keys(self):
+        """
+        The keys, as stored, that are hot in this process - or None if hot keys aren't being copied
+        """
+        if self._hot_keys is None:
+            return None
+        return self._hot_keys.hot()
+
+    def _replica_timeout(self, timeout):
+        # a copy never outlives the value it's a copy of
+        timeout = timeout or self.default_timeout
+        if timeout and 0 < timeout < self._hot_key_replica_timeout:
+            return timeout
+        return self._hot_key_replica_timeout
+
+    def _replicate(self, data, timeout):
+        """
+        Writes the hot keys in data, a dict of key -> value, to their copies. The others may be hot in another
+        process, so any copies they have are deleted - to be filled in again from the key by the next read of one.
+        """
+        copies = {}
+        cold = []
+        for key, value in data.iteritems():
+            replicas = self._hot_keys.replica_keys(key)
+            if replicas:
+                for replica in replicas:
+                    copies[replica] = value
+            else:
+                cold.append(key)
+        if copies:
+            self._memcached(self._cache.set_multi, copies, self._replica_timeout(timeout))
+        if cold:
+            self._drop_replicas(cold)
+
+    def _drop_replicas(self, keys):
+        # whether or not they're hot here
+        replicas = [replica for key in keys for replica in self._hot_keys.all_replica_keys(key)]
+        if replicas:
+            self._memcached(self._cache.delete_multi, replicas)
+
+    def _from_replicas(self, found, replicas):
+        """
+        Takes what get_multi found for a list of keys in which the copies of some hot keys stood in for them -
+        replicas is copy -> key - and returns it by key, reading the keys whose copies weren't there (and
+        filling in the copies while it's at it)
+        """
+        ret = {}
+        for k, v in (found or {}).iteritems():
+            ret[replicas.get(k, k)] = v
+        missing = [k for k in replicas.itervalues() if k not in ret]
+        if missing:
+            memcached_ok, found = self._memcached(self._cache.get_multi, missing)
+            if found:
+                ret.update(found)
+                copies = dict((r, found[k]) for r, k in replicas.iteritems() if k in found and not _is_miss(found[k]))
+                if copies:
+                    self._memcached(self._cache.set_multi, copies, self._replica_timeout(0))
+        return ret
+
+    def write_behind_stats(self):
+        """
+        Depth of the write behind queue and counts of writes made, coalesced, rejected because the queue was
+        full, and failed - or None if write behind isn't enabled
+        """
+        if self._write_behind is None:
+            return None
+        return self._write_behind.stats()
+
+    def _queue_write(self, key, value, timeout):
+        # True if the cassandra write is left to write behind, False if the caller has to make it
+        if self._write_behind is None:
+            return False
+        return self._write_behind.put(key, (key, value, timeout), self._write_behind_batch)
+
+    def _write_behind_batch(self, writes):
+        """
+        Writes a batch of queued (key, value, timeout) sets to cassandra. Values go in one batch, and if any
+        of them are counters their current values are read in one multiget and adjusted in one batch.
+        """
+        b = self._cf.batch(queue_size=len(writes)+1)
+        counters = {}
+        for key, value, timeout in writes:
+            self._insert_value(key, value, timeout, b=b)
+            if isinstance(value, ( int, long )):
+                counters[key] = value
+                self._tag_counter(key, b)
+        b.send()
+        if counters:
+            current = self._countercf.multiget(keys=counters.keys(),columns=['count'])
+            b = self._countercf.batch(queue_size=len(counters)+1)
+            for key, value in counters.iteritems():
+                b.insert(key,{'count':value-current.get(key, {}).get('count', 0)})
+            b.send()
+
+    def counter_stats(self):
+        """
+        Number of counters with changes waiting to be sent, and counts of flushes and failed flushes - or None if
+        counter changes aren't being summed
+        """
+        if self._counters is None:
+            return None
+        return self._counters.stats()
+
+    def _write_counter_deltas(self, deltas):
+        """
+        Adds a dict of key -> delta to the counters and removes their out of date vals, in one batch
+        """
+        cf, countercf = self._connect()
+        b = self._mutator(len(deltas)*3+1)
+        for key, delta in deltas.iteritems():
+            b.insert(countercf, key, {'count':delta})
+            b.remove(cf, key, ['val'])
+            if self._layout == LAYOUT_TAGGED:
+                b.insert(cf, key, {COUNTER_TAG_COLUMN:''})
+        b.send()
+
+    def _flush_counter(self, key):
+        # send any changes to key that are waiting, before reading or replacing it in cassandra
+        if self._counters is not None:
+            delta = self._counters.take(key)
+            if delta:
+                self._write_counter_deltas({key:delta})
+
+    def _flush_write_behind(self, key):
+        # make any queued write to key before changing it in place
+        if self._write_behind is not None:
+            write = self._write_behind.take(key)
+            if write is not None:
+                self._write_behind_batch([write])
+
+    def add(self, akey, value, timeout=0, version=None):
+        key = self.make_key(akey, version=version)
+        if self._l0 is not None:
+            self._l0.delete(key)
+        rv = None
+        memcached_ok = False
+        val, large = self._large_value(value, True)
+        if large:
+            self._metrics.incr('set.large')
+        memcached_value = LARGE_MARKER if large else value
+        if self._memcached_available:
+            memcached_ok, rv = self._memcached(self._cache.add, key, memcached_value, self._get_memcache_timeout(timeout))
+            if not memcached_ok:
+                rv = False
+            elif rv and self._hot_keys is not None:
+                self._replicate({key: memcached_value}, timeout)
+            elif not rv and self._negative_timeout:
+                # what's there may only be a note that there's nothing there
+                memcached_ok, existing = self._memcached(self._cache.get, key)
+                if memcached_ok and _is_miss(existing):
+                    self._memcached(self._cache.delete, key)
+                    memcached_ok, rv = self._memcached(self._cache.add, key, memcached_value, self._get_memcache_timeout(timeout))
+                    if not memcached_ok:
+                        rv = False
         
         if self._cf is not None:
-            if not self._memcached_available:
+            if not memcached_ok:
+                # we can't rely on memcached having told us if the value is already there
                 try:
-                    retval = self._cf.get(key=key,columns=['val'])
+                    retval = self._cf.get(key=key,columns=['val',COUNTER_TAG_COLUMN])
                     rv = False
-                except NotFoundException:
+                except pycassa.NotFoundException:
                     rv = True
-            if rv==True:
+            if rv==True and not self._queue_write(key, value, timeout):
                 try:
                     if isinstance(value, ( int, long )):
                         self._countercf.add(key=key,column='count',value=value)
-                    self._cf.insert(key=key,columns={'val':pickle.dumps(value)},ttl=timeout_to_ttl(timeout))
+                    self._insert_value(key, value, timeout, val)
+                    if isinstance(value, ( int, long )):
+                        self._tag_counter(key)
                 except Exception as e:
-                    print lineno(),e
-                    logger.exception("Cacheandra insert failed %r",e)
+                    self._cassandra_error("Cacheandra insert failed %r", e)
         
         return rv
 
-    def get(self, akey, default=None, version=None):
-        from polls.cache.dualcache import local_cache
+    def get(self, akey, default=None, version=None, tier=None):
+        val = self._get(akey, default, version, tier)
+        if val.__class__ is SoftValue:
+            return val.value
+        return val
+
+    def _get(self, akey, default, version, tier):
+        # get, apart from handing back SoftValues as they are
         key = self.make_key(akey, version=version)
+        use_memcached, use_cassandra = self._tiers(tier)
+        l0_wanted = self._l0_wanted(akey)
+        if l0_wanted:
+            val = self._l0.get(key)
+            if val is not None:
+                self._metrics.incr('get.l0_hit')
+                return default if _is_miss(val) else val
         val = None
+        if use_memcached:
+            # if memcached can't be used this is a cache miss
+            read_key = key
+            if self._hot_keys is not None:
+                read_key = self._hot_keys.read(key)
+            memcached_ok, val = self._memcached(self._cache.get, read_key)
+            if val is None and read_key != key:
+                # the copy isn't there yet
+                memcached_ok, val = self._memcached(self._cache.get, key)
+                if val is not None and not _is_miss(val):
+                    self._memcached(self._cache.set, read_key, val, self._replica_timeout(0))
+            if _is_large(val):
+                # only in cassandra
+                val = None
+            if val is not None:
+                if _is_miss(val):
+                    self._metrics.incr('get.negative_hit')
+                    return default
+                self._metrics.incr('get.memcached_hit')
+
+        if val is None:
+            # OK, this could be a cache miss, or we've lost a cache server - so let's try to get it from cass
+            if use_cassandra and self._cf is not None:
+                if self._single_flight is not None:
+                    val = self._single_flight.do(key, self._read_through, key, use_memcached)
+                else:
+                    val = self._read_through(key, use_memcached)
+
+            if val is None or _is_miss(val):
+                self._metrics.incr('get.miss')
+                if val is not None and l0_wanted and self._negative_l0:
+                    self._l0.set(key, val, min(self._l0_timeout, self._negative_timeout))
+                return default
+            self._metrics.incr('get.cassandra_hit')
+
+        if l0_wanted:
+            self._l0.set(key, val, self._l0_timeout)
+        return val
+
+    def get_or_set(self, akey, func, timeout=0, soft_timeout=None, version=None):
+        """
+        The value of akey - or if there isn't one, func(), which is set for timeout seconds and returned.
+        A value set this way goes stale after soft_timeout seconds (soft_timeout_ratio of timeout if not given).
+        A stale value is still returned, and func is run in the background to replace it - by one thread in one
+        process at a time. A miss runs func straight away, once in the process however many threads ask.
+        """
+        val = self._get(akey, None, version, None)
+        if val.__class__ is SoftValue:
+            if val.soft_expiry <= time.time():
+                self._refresher.submit(self.make_key(akey, version=version), self._refresh,
+                                       akey, func, timeout, soft_timeout, version)
+            return val.value
+        if val is not None:
+            # set some other way, so never stale
+            return val
+        return self._compute_flight.do(self.make_key(akey, version=version), self._set_soft,
+                                       akey, func, timeout, soft_timeout, version)
+
+    def _set_soft(self, akey, func, timeout, soft_timeout, version):
+        value = func()
+        if soft_timeout is None:
+            soft_timeout = (timeout or self.default_timeout) * self._cacheandra_options['soft_timeout_ratio']
+        self.set(akey, SoftValue(value, time.time() + soft_timeout), timeout, version)
+        return value
+
+    def _refresh(self, akey, func, timeout, soft_timeout, version):
+        lock = None
         if self._memcached_available:
+            # only one process refreshes a key at a time
+            lock = self.make_key(akey, version=version) + REFRESH_SUFFIX
+            memcached_ok, locked = self._memcached(self._cache.add, lock, 1,
+                                                   self._cacheandra_options['refresh_lock_timeout'])
+            if memcached_ok and not locked:
+                return
+        try:
+            self._set_soft(akey, func, timeout, soft_timeout, version)
+        finally:
+            if lock is not None:
+                self._memcached(self._cache.delete, lock)
+
+    def _read_through(self, key, use_memcached=True):
+        """
+        Reads key from cassandra and puts it back into memcached, unless use_memcached is False. Returns the value,
+        or None if there isn't one - MISS_MARKER if there's negative caching and cassandra confirmed that, having
+        put that in memcached.
+        With a lease timeout only the process holding the lease reads from cassandra, the others wait for the
+        value to turn up in memcached - and read it themselves if it doesn't before the lease runs out.
+        """
+        if self._write_behind is not None:
+            # it may not have reached cassandra yet
+            write = self._write_behind.get(key)
+            if write is not None:
+                return write[1]
+        try:
+            self._flush_counter(key)
+        except Exception as e:
+            self._cassandra_error("Cacheandra exception on counter batch %r", e)
+
+        use_memcached = use_memcached and self._memcached_available
+        leased = False
+        if self._lease_timeout and use_memcached and not self._breaker.is_open():
+            try:
+                leased = self._cache.add(key + LEASE_SUFFIX, 1, self._lease_timeout)
+            except _pylibmc.MemcachedError:
+                pass
+            else:
+                if not leased:
+                    val = self._wait_for_lease(key)
+                    if val is not None:
+                        # either the value or the holder's MISS_MARKER
+                        return val
+
+        try:
+            start = time.time()
+            try:
+                if self._layout == LAYOUT_TAGGED:
+                    val, backfill_timeout = self._get_tagged(key)
+                else:
+                    val, backfill_timeout = self._get_split(key)
+            except Exception as e:
+                self._cassandra_error("Cacheandra failed get %r", e)
+                return None
+            if self._metrics.enabled:
+                self._metrics.timing('cassandra.get', time.time() - start)
+
+            if val is None:
+                # cassandra answered, so it really isn't there
+                if self._negative_timeout:
+                    val = MISS_MARKER
+                    if use_memcached:
+                        self._memcached(self._cache.set, key, MISS_MARKER, self._negative_timeout)
+            elif use_memcached and backfill_timeout is not None:
+                self._metrics.incr('backfill')
+                self._memcached(self._cache.set, key, val, backfill_timeout)
+        finally:
+            if leased:
+                try:
+                    self._cache.delete(key + LEASE_SUFFIX)
+                except _pylibmc.MemcachedError:
+                    pass
+        return val
+
+    def _wait_for_lease(self, key):
+        deadline = time.time() + self._lease_timeout
+        while time.time() < deadline:
+            time.sleep(self._lease_poll)
             try:
                 val = self._cache.get(key)
-            except _pylibmc.MemcachedError as error:
-                error_num = parseMemcachedError(error)
-                if error_num == MEMCACHED_ERROR_SERVER_DISABLED_UNTIL_TIMED_RETRY:
-                    logger.info("MEMCACHED_ERROR_SERVER_DISABLED_UNTIL_TIMED_RETRY on get %s" % akey)
-                    time.sleep(self.timeoutretrydelay)
-                    val = self.get(akey,default,version)
-                elif error_num == MEMCACHED_ERROR_SERVER_IS_DEAD:
-                    logger.error("MEMCACHED_ERROR_SERVER_IS_DEAD on get %s" % key)
-                    # server is gone, cache miss
-                    val = None
+                if val is not None:
+                    # a large value isn't put back into memcached, so read it now
+                    return None if _is_large(val) else val
+                if self._cache.get(key + LEASE_SUFFIX) is None:
+                    # the holder has finished without finding anything, or died
+                    return None
+            except _pylibmc.MemcachedError:
+                return None
+        return None
+
+    def _get_split(self, key):
+        # counters first, then values - a non counter miss costs two round trips
+        # returns the value and the timeout to put it back into memcached with, or None if it's not there,
+        # and raises if cassandra fails
+        try:
+            retval = self._countercf.get(key=key,columns=['count'])
+            return retval.get('count'), self._backfill_timeout(retval)
+        except pycassa.NotFoundException:
+            pass
+        try:
+            retval = self._cf.get(key=key,columns=['val',EXPIRY_COLUMN])
+        except pycassa.NotFoundException:
+            return None, None
+        return self._loads(key, retval), self._backfill_timeout(retval)
+
+    def _get_tagged(self, key):
+        # one read of the value row answers everything, apart from a counter whose val has been
+        # invalidated by incr/decr - only those need the second read from the counter column family
+        try:
+            retval = self._cf.get(key=key,columns=['val',EXPIRY_COLUMN,COUNTER_TAG_COLUMN])
+            if 'val' in retval:
+                return self._loads(key, retval), self._backfill_timeout(retval)
+            retval = self._countercf.get(key=key,columns=['count'])
+            return retval.get('count'), self._backfill_timeout(retval)
+        except pycassa.NotFoundException:
+            return None, None
 
+    def _value_columns(self, value, timeout, val=None):
+        """
+        The columns of a value row. The absolute expiry time is stored next to the value so that a read
+        through from cassandra can put it back into memcached for the rest of its lifetime. val is value
+        already serialized, if it has been. A large value is split into chunks.
+        """
+        ttl = timeout_to_ttl(timeout)
+        if ttl is None:
+            expiry = 0
+        else:
+            expiry = int(time.time()) + ttl
         if val is None:
-            # OK, this could be a cache miss, or we've lost a cache server - so let's try to get it from cass
-            if self._cf is not None:
-                retval = {}
-                try:
-                    retval = self._countercf.get(key=key,columns=['count'])
-                    if 'count' in retval:
-                        val=retval['count']
-                except NotFoundException:
-                    try:
-                        retval = self._cf.get(key=key,columns=['val'])
-                        val=pickle.loads(retval['val'])
-                    except NotFoundException:
-                        val = default
-                    except Exception as e:
-                        print lineno(),e
-                        logger.exception("Cacheandra failed get %r",e)
-                        val = default
-                except Exception as e:
-                    print lineno(),e
-                    logger.exception("Cacheandra failed get %r",e)
-                    val = default
-                
+            val = self._serializer.dumps(value)
+        self._metrics.incr('cassandra.bytes_written', len(val))
+        columns = {EXPIRY_COLUMN:str(expiry)}
+        if self._large_value_threshold and len(val) > self._large_value_threshold:
+            chunks = range(0, len(val), self._chunk_size)
+            for n, i in enumerate(chunks):
+                columns[_chunk_column(n)] = val[i:i+self._chunk_size]
+            val = CHUNKED_HEADER + str(len(chunks))
+        columns['val'] = val
+        return columns
+
+    def _insert_value(self, key, value, timeout, val=None, b=None):
+        """
+        Writes value to the row of key, in batch b if one is given. With large values the row may hold the chunks of
+        an earlier, bigger value, which nothing would ever remove - so the row is deleted just before, in the same
+        batch, as cassandra has no way to delete columns by prefix.
+        """
+        columns = self._value_columns(value, timeout, val)
+        ttl = timeout_to_ttl(timeout)
+        if not self._large_value_threshold:
+            if b is None:
+                self._cf.insert(key=key,columns=columns,ttl=ttl)
+            else:
+                b.insert(key,columns,ttl=ttl)
+            return
+        send = b is None
+        if send:
+            b = self._cf.batch()
+        # a tombstone wins against a column written at the same time, so it goes a microsecond before
+        timestamp = int(time.time() * 1e6)
+        b.remove(key,timestamp=timestamp-1)
+        b.insert(key,columns,ttl=ttl,timestamp=timestamp)
+        if send:
+            b.send()
+
+    def _large_value(self, value, use_cassandra):
+        """
+        value serialized, and whether it's too big for memcached - which it's only kept out of if it's going
+        to cassandra and there is one. (None, False) if large values aren't looked for.
+        """
+        if not self._large_value_threshold or not use_cassandra or self._cf is None:
+            return None, False
+        val = self._serializer.dumps(value)
+        return val, len(val) > self._large_value_threshold
+
+    def _loads(self, key, columns):
+        """
+        The value in a value row, read back from its chunks if it's large. Returns None if the chunks have gone.
+        """
+        val = columns['val']
+        if val.startswith(CHUNKED_HEADER):
+            val = self._read_chunks(key, int(val[len(CHUNKED_HEADER):]))
+            if val is None:
+                return None
+        return self._serializer.loads(val)
+
+    def _read_chunks(self, key, n):
+        """
+        The n chunks of a large value joined together, read a few at a time - or None if any are missing
+        """
+        chunks = [chunk for name, chunk in self._cf.xget(key, column_start=_chunk_column(0), column_finish=_chunk_column(n-1),
+                                                         buffer_size=max(1024*1024 // self._chunk_size, 1))]
+        if len(chunks) != n:
+            return None
+        self._metrics.incr('cassandra.chunks_read', n)
+        return ''.join(chunks)
+
+    def _backfill_timeout(self, columns, granularity=1):
+        """
+        The memcached timeout for a value read from cassandra - whatever is left of its lifetime if it
+        was stored with an expiry, otherwise the default timeout. Counters never expire in cassandra.
+        None for a large value, which isn't put back into memcached.
+        """
+        if 'val' in columns and _is_chunked(columns):
+            return None
+        expiry = int(columns.get(EXPIRY_COLUMN, 0))
+        if not expiry:
+            return self._get_memcache_timeout(0)
+        remaining = expiry - int(time.time())
+        if remaining > granularity:
+            remaining -= remaining % granularity
+        # the value is still in cassandra, so if the clocks disagree give it a moment in memcached anyway
+        return self._get_memcache_timeout(max(remaining, 1))
+
+    def _tag_counter(self, key, b=None):
+        """
+        Marks the value row of key as a counter in the tagged layout. The tag has no ttl as counters
+        never expire from the counter column family. If a batch is given the tag is added to it.
+        """
+        if self._layout != LAYOUT_TAGGED:
+            return
+        if b is None:
+            self._cf.insert(key=key,columns={COUNTER_TAG_COLUMN:''})
+        else:
+            b.insert(key,{COUNTER_TAG_COLUMN:''})
+
+    def migrate_to_tagged_layout(self, batch_size=100):
+        """
+        Tags the value row of every counter in the counter column family, so that existing data can be
+        read with the tagged layout. Safe to run more than once. Returns the number of counters tagged.
+        """
+        if self._cf is None:
+            return 0
+        n = 0
+        b = self._cf.batch(queue_size=batch_size)
+        for key, columns in self._countercf.get_range(columns=['count'],buffer_size=batch_size):
+            b.insert(key,{COUNTER_TAG_COLUMN:''})
+            n += 1
+        b.send()
+        return n
+
+    def warm(self, start_token=None, finish_token=None, prefix=None, keys=None, batch_size=100, rate=0):
+        """
+        Copies values and counters from cassandra into memcached with whatever is left of their lifetimes, to
+        fill a new or restarted memcached ring. Copies keys, a list of cache keys, if given - otherwise every
+        row in the token range start_token to finish_token (all of them if not given) whose key, as stored,
+        starts with prefix. Writes batch_size keys at a time, at most rate keys a second (0 for no limit).
+        Returns the number of keys copied - a counter set since it was last changed is copied twice, from its
+        value row and from the counter. See warmup.warm to do it from several processes at once.
+        """
+        if self._cf is None or not self._memcached_available:
+            return 0
+        if keys is not None:
+            rows = self._warm_keys([self.make_key(key) for key in keys], batch_size)
+        else:
+            rows = self._warm_range(start_token, finish_token, prefix, batch_size)
+        n = 0
+        start = time.time()
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                n += self._warm_batch(batch)
+                batch = []
+                if rate:
+                    # don't get ahead of rate
+                    time.sleep(max(n / float(rate) - (time.time() - start), 0))
+        if batch:
+            n += self._warm_batch(batch)
+        return n
+
+    def _warm_keys(self, keys, batch_size):
+        for i in range(0, len(keys), batch_size):
+            found, timeouts, absent = self._cassandra_get_many(keys[i:i+batch_size])
+            for k, v in found.iteritems():
+                if timeouts[k] is not None:
+                    yield k, v, timeouts[k]
+
+    def _warm_range(self, start_token, finish_token, prefix, batch_size):
+        kwargs = {'buffer_size': batch_size}
+        if start_token is not None:
+            kwargs['start_token'] = str(start_token)
+            kwargs['finish_token'] = str(finish_token)
+        for key, columns in self._cf.get_range(columns=['val',EXPIRY_COLUMN], **kwargs):
+            if 'val' in columns and not _is_chunked(columns) and (not prefix or key.startswith(prefix)):
                 try:
-                    if val is not None and self._memcached_available:
-                        self._cache.set(key, val, self._get_memcache_timeout(1))
+                    yield key, self._serializer.loads(columns['val']), self._backfill_timeout(columns, BACKFILL_TIMEOUT_GRANULARITY)
                 except Exception as e:
-                    print lineno(),e
-                    logger.exception("Cacheandra failed insert after get %r",e)
-            else:
-                val=default
-                
-        return val
+                    self._cassandra_error("Cacheandra failed to load %r", e)
+        for key, columns in self._countercf.get_range(columns=['count'], **kwargs):
+            if 'count' in columns and (not prefix or key.startswith(prefix)):
+                yield key, columns['count'], self._backfill_timeout(columns)
+
+    def _warm_batch(self, batch):
+        """
+        Writes a list of (key, value, timeout) to memcached, one set_multi per timeout. Returns how many were written.
+        """
+        by_timeout = {}
+        for key, value, timeout in batch:
+            by_timeout.setdefault(timeout, {})[key] = value
+        n = 0
+        for timeout, data in by_timeout.iteritems():
+            memcached_ok, failed = self._memcached(self._cache.set_multi, data, timeout)
+            if memcached_ok:
+                n += len(data) - len(failed or ())
+        return n
 
-    def set(self, akey, value, timeout=0, version=None):
+    def set(self, akey, value, timeout=0, version=None, tier=None):
         key = self.make_key(akey, version=version)
+        use_memcached, use_cassandra = self._tiers(tier)
+        val, large = self._large_value(value, use_cassandra)
+        if large:
+            self._metrics.incr('set.large')
+        if use_memcached:
+            self._set_memcached(key, LARGE_MARKER if large else value, timeout)
+        else:
+            # don't leave an older value there
+            self._delete_memcached(key)
+        if use_cassandra:
+            self._set_cassandra(key, value, timeout, val)
+
+    # each write is made in two halves, memcached and cassandra, which AsyncCacheClient makes at the same time
+
+    def _set_memcached(self, key, value, timeout):
+        if self._l0 is not None:
+            self._l0.delete(key)
         if self._memcached_available:
-            try:
-                self._cache.set(key, value, self._get_memcache_timeout(timeout))
-            except _pylibmc.MemcachedError as error:
-                error_num = parseMemcachedError(error)
-                if error_num == MEMCACHED_ERROR_SERVER_DISABLED_UNTIL_TIMED_RETRY:
-                    logger.info("MEMCACHED_ERROR_SERVER_DISABLED_UNTIL_TIMED_RETRY on set %s %s" % (akey, value))
-                    time.sleep(self.timeoutretrydelay)
-                    self.set(akey, value, timeout, version)
-                elif error_num == MEMCACHED_ERROR_SERVER_IS_DEAD:
-                    # next attempt should succeed, else we'll raise the error
-                    logger.error("MEMCACHED_ERROR_SERVER_IS_DEAD on set %s %s" % (akey, value))
-                    self._cache.set(key, value, self._get_memcache_timeout(timeout))
-        
+            self._memcached(self._cache.set, key, value, self._get_memcache_timeout(timeout))
+            if self._hot_keys is not None:
+                self._replicate({key: value}, timeout)
+
+    def _set_cassandra(self, key, value, timeout, val=None):
         if self._cf is not None:
+            if self._counters is not None:
+                # the new value replaces any changes waiting to be sent
+                self._counters.take(key)
+            if self._queue_write(key, value, timeout):
+                return
             try:
-                self._cf.insert(key=key,columns={'val':pickle.dumps(value)},ttl=timeout_to_ttl(timeout))
+                self._insert_value(key, value, timeout, val)
                 if isinstance(value, ( int, long )):
                     try:
                         val = self._countercf.get(key=key,columns=['count'])
                         if 'count' in val:
                             value-=val['count']
-                    except NotFoundException:
+                    except pycassa.NotFoundException:
                         pass
                     finally:
                         self._countercf.add(key=key,column='count',value=value)
+                        self._tag_counter(key)
             except Exception as e:
-                print timeout
-                print lineno(),e
-                logger.exception("Cacheandra insert failed %r",e)
+                self._cassandra_error("Cacheandra insert failed %r", e)
 
     def delete(self, akey, version=None):
         key = self.make_key(akey, version=version)
+        self._delete_memcached(key)
+        self._delete_cassandra(key)
+
+    def _delete_memcached(self, key):
+        if self._l0 is not None:
+            self._l0.delete(key)
         if self._memcached_available:
-            try:
-                self._cache.delete(key)
-            except _pylibmc.MemcachedError as error:
-                error_num = parseMemcachedError(error)
-                if error_num == MEMCACHED_ERROR_SERVER_DISABLED_UNTIL_TIMED_RETRY:
-                    logger.info("MEMCACHED_ERROR_SERVER_DISABLED_UNTIL_TIMED_RETRY on delete %s" % (akey))
-                    time.sleep(self.timeoutretrydelay)
-                    self.delete(akey, version)
-        
-        if self._cf is not None:
-            try:
-                self._cf.remove(key=key,columns=['val'])
-            except Exception as e:
-                print lineno(),e
-                logger.exception("Cacheandra remove failed %r",e)
-            try:
-                self._countercf.remove_counter(key=key,column='count')
-            except Exception as e:
-                print lineno(),e
-                logger.exception("Cacheandra remove_counter failed %r",e)
+            self._memcached(self._cache.delete, key)
+            if self._hot_keys is not None:
+                self._drop_replicas([key])
 
-    def get_many(self, keys, version=None):
+    def _delete_cassandra(self, key):
+        self._delete_many_cassandra([key])
+
+    def _mutator(self, queue_size):
+        """
+        A batch of changes to both column families, sent to cassandra in one call
+        """
+        cf = self._cf
+        return pycassa_batch.Mutator(cf.pool, queue_size=queue_size, write_consistency_level=cf.write_consistency_level)
+
+    def get_many(self, keys, version=None, tier=None):
         new_keys = map(lambda x: self.make_key(x, version=version), keys)
+        use_memcached, use_cassandra = self._tiers(tier)
+        m = dict(zip(new_keys, keys))
+        local = {}
+        if self._l0 is not None:
+            local = self._l0.get_many([k for k in new_keys if self._l0_wanted(m[k])])
+            if local:
+                new_keys = [k for k in new_keys if k not in local]
+                if self._negative_l0:
+                    local = dict((k, v) for k, v in local.iteritems() if not _is_miss(v))
         ret = None
-        if self._memcached_available:
-            try:
-                ret = self._cache.get_multi(new_keys)
-            except _pylibmc.MemcachedError as error:
-                error_num = parseMemcachedError(error)
-                if error_num == MEMCACHED_ERROR_SERVER_DISABLED_UNTIL_TIMED_RETRY:
-                    logger.info("MEMCACHED_ERROR_SERVER_DISABLED_UNTIL_TIMED_RETRY on get_many %s" % (keys))
-                    time.sleep(self.timeoutretrydelay)
-                    ret = self.get_many(keys,version)
-                elif error_num == MEMCACHED_ERROR_SERVER_IS_DEAD:
-                    logger.error("MEMCACHED_ERROR_SERVER_IS_DEAD on get_many %s" % (keys))
-                    ret = {}
+        negative = ()
+        if local:
+            self._metrics.incr('get_many.l0_hit', len(local))
+        if use_memcached:
+            if self._hot_keys is not None:
+                # hot keys are read from one of their copies
+                read_keys = [self._hot_keys.read(k) for k in new_keys]
+                replicas = dict((r, k) for r, k in zip(read_keys, new_keys) if r != k)
+                memcached_ok, ret = self._memcached(self._cache.get_multi, read_keys)
+                if replicas:
+                    ret = self._from_replicas(ret, replicas)
+            else:
+                memcached_ok, ret = self._memcached(self._cache.get_multi, new_keys)
+            if ret and self._large_value_threshold:
+                # read from cassandra with the keys that missed
+                for k in [k for k, v in ret.iteritems() if _is_large(v)]:
+                    del ret[k]
+            if ret and self._negative_timeout:
+                negative = set(k for k, v in ret.iteritems() if _is_miss(v))
+                for k in negative:
+                    del ret[k]
+                self._metrics.incr('get_many.negative_hit', len(negative))
             if ret:
+                self._metrics.incr('get_many.memcached_hit', len(ret))
                 _ = {}
-                m = dict(zip(new_keys, keys))
                 for k, v in ret.items():
                     _[m[k]] = v
                 ret = _
 
         if ret == None: # this should be impossible
             ret = {}
-        
-        if ret=={}:
-            # empty set, let's have a go at getting the values from cassandra and caching them
-            try:
-                value_ret = self._cf.multiget(keys=list(new_keys))
-                _ = {}
-                m = dict(zip(new_keys, keys))
-                for k, v in value_ret.iteritems():
-                    _[m[k]] = pickle.loads(v['val'])
-                blank_new_keys = []
-                for k in new_keys:
-                    if not k in _:
-                        blank_new_keys.append(k)
-                if len(blank_new_keys)>0:
-                    value_ret = self._countercf.multiget(keys=blank_new_keys)
-                    for k, v in value_ret.iteritems():
-                        _[m[k]] = v['count']
-            
-                ret = _
-            
-                safe_data = {}
-                for key, value in _.items():
-                    key = self.make_key(key, version=version)
-                    safe_data[key] = value
+
+        if use_cassandra and self._cf is not None:
+            # only go to cassandra for the keys memcached didn't return - a partial result usually
+            # means one server in the ring has gone, and the rest of the batch is still good
+            missing_keys = [k for k in set(new_keys) if m[k] not in ret and k not in negative]
+            if self._write_behind is not None:
+                # some of them may not have reached cassandra yet
+                for k in missing_keys:
+                    write = self._write_behind.get(k)
+                    if write is not None:
+                        ret[m[k]] = write[1]
+                missing_keys = [k for k in missing_keys if m[k] not in ret]
+            if missing_keys:
+                if self._counters is not None:
+                    deltas = dict((k, self._counters.take(k)) for k in missing_keys)
+                    deltas = dict((k, delta) for k, delta in deltas.iteritems() if delta)
+                    if deltas:
+                        try:
+                            self._write_counter_deltas(deltas)
+                        except Exception as e:
+                            self._cassandra_error("Cacheandra exception on counter batch %r", e)
+                start = time.time()
+                found, timeouts, absent = self._cassandra_get_many(missing_keys)
+                if self._metrics.enabled:
+                    self._metrics.timing('cassandra.get_many', time.time() - start)
+                    self._metrics.incr('get_many.cassandra_hit', len(found))
+                    self._metrics.incr('get_many.miss', len(missing_keys) - len(found))
+                    if use_memcached:
+                        self._metrics.incr('backfill', len(found))
+
+                backfill = {}
+                for k, v in found.iteritems():
+                    ret[m[k]] = v
+                    if timeouts[k] is not None:
+                        backfill.setdefault(timeouts[k], {})[k] = v
+
+                if use_memcached:
+                    for backfill_timeout, data in backfill.iteritems():
+                        self._memcached(self._cache.set_multi, data, backfill_timeout)
+
+                if absent and self._negative_timeout:
+                    if use_memcached:
+                        self._memcached(self._cache.set_multi, dict.fromkeys(absent, MISS_MARKER), self._negative_timeout)
+                    if self._negative_l0:
+                        for k in absent:
+                            if self._l0_wanted(m[k]):
+                                self._l0.set(k, MISS_MARKER, min(self._l0_timeout, self._negative_timeout))
+
+        if self._l0 is not None:
+            for k in new_keys:
+                if m[k] in ret and self._l0_wanted(m[k]):
+                    self._l0.set(k, ret[m[k]], self._l0_timeout)
+            for k, v in local.iteritems():
+                ret[m[k]] = v
+
+        for k, v in ret.iteritems():
+            if v.__class__ is SoftValue:
+                ret[k] = v.value
+        return ret
+
+    def _cassandra_get_many(self, keys):
+        """
+        Reads keys from cassandra in chunks of get_many_chunk_size, all at once. Returns the values found,
+        the timeouts to put them back into memcached with, and the keys cassandra confirmed aren't there.
+        Keys in a chunk that fails are left out of all three.
+        """
+        size = self._cacheandra_options['get_many_chunk_size']
+        chunks = [keys[i:i+size] for i in range(0, len(keys), size)]
+        calls = [(self._cf.multiget, (chunk, ['val',EXPIRY_COLUMN,COUNTER_TAG_COLUMN])) for chunk in chunks]
+        if self._layout == LAYOUT_SPLIT:
+            # any of them could be a counter, so read the counter column family at the same time
+            calls += [(self._countercf.multiget, (chunk, ['count'])) for chunk in chunks]
+        results = self._concurrently(calls)
+
+        value_rows = {}
+        counter_rows = {}
+        answered = set()
+        for chunk, result in zip(chunks, results[:len(chunks)]):
+            if result is not None:
+                value_rows.update(result)
+                answered.update(chunk)
+        if self._layout == LAYOUT_SPLIT:
+            for chunk, result in zip(chunks, results[len(chunks):]):
+                if result is not None:
+                    counter_rows.update(result)
+                else:
+                    answered.difference_update(chunk)
+        # anything with a value row is there in some form, even if it failed to load
+        absent = [k for k in answered if k not in value_rows and k not in counter_rows]
+
+        if self._layout == LAYOUT_TAGGED:
+            # only rows tagged as counters can be in the counter column family
+            counter_keys = [k for k, v in value_rows.iteritems() if 'val' not in v]
+            chunks = [counter_keys[i:i+size] for i in range(0, len(counter_keys), size)]
+            for result in self._concurrently([(self._countercf.multiget, (chunk, ['count'])) for chunk in chunks]):
+                counter_rows.update(result or {})
+
+        found = {}
+        timeouts = {}
+        for k, v in counter_rows.iteritems():
+            found[k] = v['count']
+            timeouts[k] = self._backfill_timeout(v)
+        large = []
+        for k, v in value_rows.iteritems():
+            if 'val' in v:
+                if _is_chunked(v):
+                    large.append(k)
+                    continue
                 try:
-                    # we've got that missing ttl problem again
-                    if self._memcached_available:
-                        self._cache.set_multi(safe_data, self._get_memcache_timeout(1))
+                    found[k] = self._serializer.loads(v['val'])
+                    timeouts[k] = self._backfill_timeout(v, BACKFILL_TIMEOUT_GRANULARITY)
                 except Exception as e:
-                    print lineno(),e
-                    logger.exception("Cacheandra failed in cache set_multi %r",e)
+                    self._cassandra_error("Cacheandra failed to load %r", e)
+        if large:
+            # their chunks are read at the same time
+            results = self._concurrently([(self._loads, (k, value_rows[k])) for k in large], 'chunk read')
+            for k, value in zip(large, results):
+                if value is not None:
+                    found[k] = value
+                    timeouts[k] = None
+        return found, timeouts, absent
+
+    def _concurrently(self, calls, what='multiget'):
+        """
+        Makes a list of (func, args) calls on the executor, and returns their results in order - None for any
+        call that failed or hadn't finished after get_many_timeout. A single call is made on this thread.
+        what is the kind of call, for logging failures.
+        """
+        if not calls:
+            return []
+        if len(calls) == 1:
+            func, args = calls[0]
+            try:
+                return [func(*args)]
             except Exception as e:
-                print lineno(),e
-                logger.exception("Cacheandra failed in multiget %r",e)
-        
-        return ret
+                self._cassandra_error("Cacheandra failed in " + what + " %r", e)
+                return [None]
+
+        executor = get_executor(self._cacheandra_options['executor_size'])
+        pending = [executor.apply_async(func, args) for func, args in calls]
+        deadline = time.time() + self._cacheandra_options['get_many_timeout']
+        results = []
+        for p in pending:
+            try:
+                results.append(p.get(max(deadline - time.time(), 0)))
+            except Exception as e:
+                self._cassandra_error("Cacheandra failed in " + what + " %r", e)
+                results.append(None)
+        return results
 
     def close(self, **kwargs):
+        """
+        Django calls this after every request, once the response has gone. It waits at most
+        write_behind_close_timeout seconds for the write behind queue, which is shared with every other thread -
+        writes still queued after that stay queued and are made in the background or at exit, and are lost only
+        if the process is killed first. Call flush() where that matters.
+        """
+        if self._write_behind is not None:
+            self._write_behind.flush(self._cacheandra_options['write_behind_close_timeout'])
         self._cache.disconnect_all()
 
+    def flush(self):
+        """
+        Makes every write this process is holding back - queued by write behind or summed up by
+        counter_flush_interval, for any backend sharing the queue - and returns once they're done, however
+        long that takes.
+        """
+        if self._write_behind is not None:
+            self._write_behind.flush()
+        if self._counters is not None:
+            self._counters.flush()
+
     def incr(self, akey, delta=1, version=None):
+        return self._incr(akey, delta, version)
+
+    def _incr(self, akey, delta, version):
         key = self.make_key(akey, version=version)
+        if self._l0 is not None:
+            self._l0.delete(key)
         val = None
+        memcached_ok = False
         if self._memcached_available:
+            if self._hot_keys is not None:
+                # copies of a counter would go out of date
+                self._drop_replicas([key])
+            # memcached won't take a negative delta, decrements have to be asked for
+            if delta < 0:
+                func, memcached_delta = self._cache.decr, -delta
+            else:
+                func, memcached_delta = self._cache.incr, delta
             try:
-                val = self._cache.incr(key, delta)
+                memcached_ok, val = self._memcached(func, key, memcached_delta)
             except pylibmc.NotFound:
-                val = None
-            except _pylibmc.MemcachedError as error:
-                error_num = parseMemcachedError(error)
-                if error_num == MEMCACHED_ERROR_SERVER_DISABLED_UNTIL_TIMED_RETRY:
-                    logger.info("MEMCACHED_ERROR_SERVER_DISABLED_UNTIL_TIMED_RETRY on incr %s %s" % (akey, delta))
-                    time.sleep(self.timeoutretrydelay)
-                    self.incr(akey, delta, version)
-                elif error_num == MEMCACHED_ERROR_SERVER_IS_DEAD:
-                    logger.error("MEMCACHED_ERROR_SERVER_IS_DEAD on incr %s %s" % (akey, delta))
-                    try:
-                        self._cache.incr(key, delta)
-                    except pylibmc.NotFound:
-                        val = None
-
-            if val is None:
-                raise ValueError("Key '%s' not found" % key)            
+                raise ValueError("Key '%s' not found" % key)
+            if not memcached_ok and self._countercf is None:
+                raise ValueError("Key '%s' not found" % key)
         
         if self._countercf is not None:
-            if not self._memcached_available:
-                # we can't rely on memcached having told us if the value isn't there
+            self._flush_write_behind(key)
+            if memcached_ok and self._counter_mode == COUNTER_MODE_FAST:
+                # memcached has the answer, cassandra just needs to hear about the change
+                if self._counters is not None:
+                    self._counters.add(key, delta, self._write_counter_deltas)
+                    return val
                 try:
-                    retval = self._countercf.get(key,columns=['count'])
-                except NotFoundException:
-                    raise ValueError("Key '%s' not found" % key)            
-            try:
-                self._countercf.add(key,'count',delta)
-                # we are changing the value, so remove the duplicate (now old) value from the non counter CF
-                self._cf.remove(key=key,columns=['val'])
-                try:
-                    retval = self._countercf.get(key,columns=['count'])
-                    if 'count' in retval:
-                        val=retval['count']
+                    self._write_counter_deltas({key:delta})
                 except Exception as e:
-                    print lineno(),e
-                    logger.exception("Cacheandra exception on retrieve of counter incr %r",e)
-            except Exception as e:
-                print lineno(),e
-                logger.exception("Cacheandra exception on add %r",e)
-        return val
-
-    def decr(self, akey, delta=1, version=None):
-        key = self.make_key(akey, version=version)
-        val = None
-        if self._memcached_available:
-            try:
-                val = self._cache.decr(key, delta)
-            except pylibmc.NotFound:
-                val = None
-            except _pylibmc.MemcachedError as error:
-                error_num = parseMemcachedError(error)
-                if error_num == MEMCACHED_ERROR_SERVER_DISABLED_UNTIL_TIMED_RETRY:
-                    logger.info("MEMCACHED_ERROR_SERVER_DISABLED_UNTIL_TIMED_RETRY on decr %s %s" % (akey, delta))
-                    time.sleep(self.timeoutretrydelay)
-                    self.decr(akey, delta, version)
-                elif error_num == MEMCACHED_ERROR_SERVER_IS_DEAD:
-                    logger.error("MEMCACHED_ERROR_SERVER_IS_DEAD on decr %s %s" % (akey, delta))
-                    try:
-                        self._cache.decr(key, delta)
-                    except pylibmc.NotFound:
-                        val = None
+                    self._cassandra_error("Cacheandra exception on counter batch %r", e)
+                return val
 
-        if self._countercf is not None:
-            if not self._memcached_available:
+            if not memcached_ok:
                 # we can't rely on memcached having told us if the value isn't there
                 try:
                     retval = self._countercf.get(key,columns=['count'])
-                except NotFoundException:
+                except pycassa.NotFoundException:
                     raise ValueError("Key '%s' not found" % key)            
             try:
-                self._countercf.add(key,'count',-delta)
+                self._countercf.add(key,'count',delta)
                 # we are changing the value, so remove the duplicate (now old) value from the non counter CF
-                self._cf.remove(key=key,columns=['val'])
+                if self._layout == LAYOUT_TAGGED:
+                    b = self._cf.batch()
+                    b.remove(key,['val'])
+                    self._tag_counter(key, b)
+                    b.send()
+                else:
+                    self._cf.remove(key=key,columns=['val'])
                 try:
                     retval = self._countercf.get(key,columns=['count'])
                     if 'count' in retval:
                         val=retval['count']
                 except Exception as e:
-                    print lineno(),e
-                    logger.exception("Cacheandra exception on retrieve of counter decr %r",e)
+                    self._cassandra_error("Cacheandra exception on retrieve of counter incr %r", e)
             except Exception as e:
-                print lineno(),e
-                logger.exception("Cacheandra exception on add %r",e)
+                self._cassandra_error("Cacheandra exception on add %r", e)
 
         if val is None:
             raise ValueError("Key '%s' not found" % key)
         return val
 
-    def set_many(self, data, timeout=0, version=None):
+    def decr(self, akey, delta=1, version=None):
+        # not through incr, which may be wrapped to time it
+        return self._incr(akey, -delta, version)
+
+    def set_many(self, data, timeout=0, version=None, tier=None):
         safe_data = {}
         for key, value in data.items():
             key = self.make_key(key, version=version)
             safe_data[key] = value
+        use_memcached, use_cassandra = self._tiers(tier)
+        vals = None
+        memcached_data = safe_data
+        if self._large_value_threshold and use_cassandra and self._cf is not None:
+            vals = dict((key, self._serializer.dumps(value)) for key, value in safe_data.iteritems())
+            memcached_data = dict((key, value if len(vals[key]) <= self._large_value_threshold else LARGE_MARKER)
+                                  for key, value in safe_data.iteritems())
+            self._metrics.incr('set.large', sum(1 for value in memcached_data.itervalues() if _is_large(value)))
+        if use_memcached:
+            self._set_many_memcached(memcached_data, timeout)
+        else:
+            self._delete_many_memcached(safe_data.keys())
+        if use_cassandra:
+            self._set_many_cassandra(safe_data, timeout, vals)
+
+    def _set_many_memcached(self, safe_data, timeout):
+        if self._l0 is not None:
+            self._l0.delete_many(safe_data.keys())
         if self._memcached_available:
-            try:
-                self._cache.set_multi(safe_data, self._get_memcache_timeout(timeout))
-            except _pylibmc.MemcachedError as error:
-                error_num = parseMemcachedError(error)
-                if error_num == MEMCACHED_ERROR_SERVER_DISABLED_UNTIL_TIMED_RETRY:
-                    logger.info("MEMCACHED_ERROR_SERVER_DISABLED_UNTIL_TIMED_RETRY on set_many %s" % (data))
-                    time.sleep(self.timeoutretrydelay)
-                    self.set_many(data,timeout,version)
-                elif error_num == MEMCACHED_ERROR_SERVER_IS_DEAD:
-                    logger.error("MEMCACHED_ERROR_SERVER_IS_DEAD on set_many %s" % (data))
-                    self._cache.set_multi(safe_data, self._get_memcache_timeout(timeout))
-        
+            self._memcached(self._cache.set_multi, safe_data, self._get_memcache_timeout(timeout))
+            if self._hot_keys is not None:
+                self._replicate(safe_data, timeout)
+
+    def _set_many_cassandra(self, safe_data, timeout, vals=None):
         if self._cf is not None:
+            if self._counters is not None:
+                for key in safe_data:
+                    self._counters.take(key)
+            if self._write_behind is not None:
+                safe_data = dict((key, value) for key, value in safe_data.iteritems()
+                                 if not self._queue_write(key, value, timeout))
             try:
                 b=self._cf.batch(queue_size=100)
-                for key, value in data.items():
-                    key = self.make_key(key, version=version)
-                    b.insert(key=key,column={'val':pickle.dumps(value)},ttl=timeout_to_ttl(timeout))
+                for key, value in safe_data.iteritems():
+                    self._insert_value(key, value, timeout, vals and vals[key], b)
                 b.send()
             except Exception as e:
-                print lineno(),e
-                logger.exception("Cacheandra batch insert failed %r",e)
+                self._cassandra_error("Cacheandra batch insert failed %r", e)
 
     def delete_many(self, keys, version=None):
-        l = lambda x: self.make_key(x, version=version)
+        keys = [self.make_key(key, version=version) for key in keys]
+        self._delete_many_memcached(keys)
+        self._delete_many_cassandra(keys)
+
+    def _delete_many_memcached(self, keys):
+        if self._l0 is not None:
+            self._l0.delete_many(keys)
         if self._memcached_available:
-            try:
-                self._cache.delete_multi(map(l, keys))
-            except _pylibmc.MemcachedError as error:
-                error_num = parseMemcachedError(error)
-                if error_num == MEMCACHED_ERROR_SERVER_DISABLED_UNTIL_TIMED_RETRY:
-                    logger.info("MEMCACHED_ERROR_SERVER_DISABLED_UNTIL_TIMED_RETRY on delete_many %s" % (keys))
-                    time.sleep(self.timeoutretrydelay)
-                    self.delete_many(keys, version)
-                # special case, if the server has been marked dead, we don't need to worry about deleting!
+            # if a server has been marked dead, we don't need to worry about deleting from it
+            self._memcached(self._cache.delete_multi, keys)
+            if self._hot_keys is not None:
+                self._drop_replicas(keys)
 
-        if self._cf is not None:
-            try:
-                b = self._cf.batch(queue_size=100)
-                for key in keys:
-                    b.remove(key,['val'])
-                b.send()
-            except Exception as e:
-                print lineno(),e
-                logger.exception("Cacheandra batch remove failed %r",e)
+    def _delete_many_cassandra(self, keys):
+        """
+        Removes the value rows and counters of keys in batches of delete_batch_size keys, all sent at once
+        """
+        if self._cf is None:
+            return
+        if self._write_behind is not None:
+            for key in keys:
+                self._write_behind.take(key)
+        if self._counters is not None:
+            for key in keys:
+                self._counters.take(key)
+        cf, countercf = self._connect()
+        size = self._cacheandra_options['delete_batch_size']
+        calls = []
+        for i in range(0, len(keys), size):
+            chunk = keys[i:i+size]
+            b = self._mutator(len(chunk)*2+1)
+            for key in chunk:
+                b.remove(cf, key)
+                b.remove(countercf, key, ['count'])
+            calls.append((b.send, ()))
+        self._concurrently(calls, 'batch remove')
+
+    # the operations of a cache with only memcached, with nothing in the way of its client - see MEMCACHED_ONLY_OPERATIONS
+
+    def _memcached_only_get(self, akey, default=None, version=None, tier=None):
+        if tier is not None and not self._tiers(tier)[0]:
+            return default
+        memcached_ok, val = self._memcached(self._cache.get, self.make_key(akey, version=version))
+        if val is None:
+            if self._metrics.enabled:
+                self._metrics.incr('get.miss')
+            return default
+        if self._metrics.enabled:
+            self._metrics.incr('get.memcached_hit')
+        if val.__class__ is SoftValue:
+            return val.value
+        return val
+
+    def _memcached_only_get_many(self, keys, version=None, tier=None):
+        if tier is not None and not self._tiers(tier)[0]:
+            return {}
+        new_keys = [self.make_key(key, version=version) for key in keys]
+        memcached_ok, found = self._memcached(self._cache.get_multi, new_keys)
+        ret = {}
+        if found:
+            for key, new_key in zip(keys, new_keys):
+                val = found.get(new_key)
+                if val is not None:
+                    ret[key] = val.value if val.__class__ is SoftValue else val
+        if self._metrics.enabled:
+            self._metrics.incr('get_many.memcached_hit', len(ret))
+            self._metrics.incr('get_many.miss', len(new_keys) - len(ret))
+        return ret
+
+    def _memcached_only_set(self, akey, value, timeout=0, version=None, tier=None):
+        key = self.make_key(akey, version=version)
+        if tier is not None and not self._tiers(tier)[0]:
+            # don't leave an older value there
+            self._memcached(self._cache.delete, key)
+            return
+        self._memcached(self._cache.set, key, value, self._get_memcache_timeout(timeout))
+
+    def _memcached_only_set_many(self, data, timeout=0, version=None, tier=None):
+        safe_data = dict((self.make_key(key, version=version), value) for key, value in data.iteritems())
+        if tier is not None and not self._tiers(tier)[0]:
+            self._memcached(self._cache.delete_multi, safe_data.keys())
+            return
+        self._memcached(self._cache.set_multi, safe_data, self._get_memcache_timeout(timeout))
+
+    def _memcached_only_add(self, akey, value, timeout=0, version=None):
+        memcached_ok, rv = self._memcached(self._cache.add, self.make_key(akey, version=version), value,
+                                           self._get_memcache_timeout(timeout))
+        return memcached_ok and rv
+
+    def _memcached_only_delete(self, akey, version=None):
+        self._memcached(self._cache.delete, self.make_key(akey, version=version))
+
+    def _memcached_only_delete_many(self, keys, version=None):
+        self._memcached(self._cache.delete_multi, [self.make_key(key, version=version) for key in keys])
+
+    def _memcached_only_incr(self, akey, delta=1, version=None):
+        key = self.make_key(akey, version=version)
+        # memcached won't take a negative delta, decrements have to be asked for
+        if delta < 0:
+            func, delta = self._cache.decr, -delta
+        else:
+            func = self._cache.incr
+        try:
+            memcached_ok, val = self._memcached(func, key, delta)
+        except pylibmc.NotFound:
+            raise ValueError("Key '%s' not found" % key)
+        if val is None:
+            raise ValueError("Key '%s' not found" % key)
+        return val
+
+    def _memcached_only_decr(self, akey, delta=1, version=None):
+        return self._memcached_only_incr(akey, -delta, version)
 
     def clear(self):
+        if self._l0 is not None:
+            self._l0.clear()
+        if self._generations is not None:
+            # nothing is removed, it just can't be read any more
+            self._next_generation(None)
+            return
+        self.truncate()
+
+    def clear_prefix(self, prefix):
+        """
+        Clears the keys in the namespace prefix - the keys that start with prefix and generation_separator -
+        by moving its generation on. Needs generations, and prefix in generation_namespaces.
+        """
+        if self._generations is None:
+            raise ValueError("Cacheandra: clear_prefix needs generations turned on")
+        if prefix.endswith(self._generation_separator):
+            prefix = prefix[:-len(self._generation_separator)]
+        if prefix not in self._generation_namespaces:
+            raise ValueError("Cacheandra: %r isn't one of generation_namespaces" % prefix)
+        self._next_generation(prefix)
+
+    def truncate(self):
+        """
+        Removes everything from memcached and both column families. Truncating is slow and affects the whole
+        cassandra cluster - with generations clear() is usually enough.
+        """
+        if self._l0 is not None:
+            self._l0.clear()
+        if self._generations is not None:
+            # they've gone from both tiers too
+            self._generations.clear()
+        if self._write_behind is not None:
+            self._write_behind.discard_all()
+        if self._counters is not None:
+            self._counters.discard_all()
         self._cache.flush_all()
         try:
             self._cf.truncate()
@@ -0,0 +1,156 @@
+"""
+Concurrency helpers for cacheandra
+"""
+
+import logging
+import os
+import time
+from multiprocessing.pool import ThreadPool
+from threading import Event, Lock
+
+from .registry import per_location
+
+logger = logging.getLogger(__name__)
+
+"""
+Pools of threads per process, by name, made on first use and again after a fork. 'cassandra' runs cassandra calls
+concurrently, 'async' runs the calls of AsyncCacheClient and 'refresh' the refreshes of stale values - both of which
+wait on the 'cassandra' pool, so they can't share it.
+"""
+
+_executors = {}
+_executors_lock = Lock()
+
+def get_executor(size, name='cassandra'):
+    with _executors_lock:
+        executor = _executors.get(name)
+        if executor is None or executor[0] != os.getpid():
+            executor = (os.getpid(), ThreadPool(size))
+            _executors[name] = executor
+        return executor[1]
+
+class Future(object):
+    """
+    The result of one or more calls made on an executor with apply_async. get() waits for them all and returns
+    combine(list of their results), or the result of the first if there's no combine. If any of them raised,
+    get() raises the same exception.
+    """
+
+    def __init__(self, results, combine=None):
+        self._results = results
+        self._combine = combine
+
+    def ready(self):
+        return all(result.ready() for result in self._results)
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        for result in self._results:
+            result.wait(None if deadline is None else max(deadline - time.time(), 0))
+        return self.ready()
+
+    def get(self, timeout=None):
+        """
+        The result, waiting at most timeout seconds for it - multiprocessing.TimeoutError if it isn't ready by then
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        values = [result.get(None if deadline is None else max(deadline - time.time(), 0))
+                  for result in self._results]
+        if self._combine is None:
+            return values[0]
+        return self._combine(values)
+
+_single_flights = {}
+
+def get_single_flight(location):
+    return per_location(_single_flights, location, SingleFlight)
+
+class _Call(object):
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight(object):
+    """
+    Runs at most one call per key at a time. Callers that ask for a key while a call for it is already
+    running wait for that call and get its result (or its exception) instead of making their own.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+_refreshers = {}
+
+def get_refresher(location, size):
+    return per_location(_refreshers, (location, size), lambda: Refresher(size))
+
+class Refresher(object):
+    """
+    Runs func(*args) for a key on the 'refresh' pool of size threads, unless it's already running for that key in
+    this process - callers don't wait for it. Failures are logged.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._lock = Lock()
+        self._running = set()
+        self._pid = os.getpid()
+
+    def submit(self, key, func, *args):
+        """
+        Returns False if func was already running for key
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # whatever was running is in the parent
+                self._pid = os.getpid()
+                self._running = set()
+            if key in self._running:
+                return False
+            self._running.add(key)
+        get_executor(self.size, 'refresh').apply_async(self._run, (key, func, args))
+        return True
+
+    def _run(self, key, func, args):
+        try:
+            func(*args)
+        except Exception as e:
+            logger.exception("Cacheandra refresh failed %r", e)
+        finally:
+            with self._lock:
+                self._running.discard(key)
+
+    def running(self):
+        with self._lock:
+            return len(self._running)
@@ -0,0 +1,51 @@
+"""
+Generation numbers for cacheandra
+"""
+
+import time
+from collections import OrderedDict
+
+from .registry import per_location
+
+_generations = {}
+
+def get_generations(location, timeout, namespaces):
+    # the cache's own generation, and one per namespace
+    return per_location(_generations, (location, timeout, namespaces),
+                        lambda: Generations(timeout, len(namespaces) + 1))
+
+class Generations(object):
+    """
+    Remembers generation numbers by name for timeout seconds after they're loaded, so that working out a key
+    doesn't cost a round trip. get() loads a name it doesn't know, or has forgotten, with load(name) - which
+    returns None if it can't tell, in which case the last known generation (or 0) is used for now. At most
+    max_names are remembered, the least recently loaded are forgotten first.
+    """
+
+    def __init__(self, timeout, max_names):
+        self.timeout = timeout
+        self.max_names = max_names
+        self._generations = OrderedDict()
+
+    def get(self, name, load):
+        entry = self._generations.get(name)
+        now = time.time()
+        if entry is not None and entry[1] > now:
+            return entry[0]
+        generation = load(name)
+        if generation is None:
+            generation = entry[0] if entry is not None else 0
+        self._remember(name, generation, now)
+        return generation
+
+    def set(self, name, generation):
+        self._remember(name, generation, time.time())
+
+    def _remember(self, name, generation, now):
+        self._generations.pop(name, None)
+        self._generations[name] = (generation, now + self.timeout)
+        while len(self._generations) > self.max_names:
+            self._generations.popitem(last=False)
+
+    def clear(self):
+        self._generations = OrderedDict()
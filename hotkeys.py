@@ -0,0 +1,125 @@
+"""
+Hot key detection for cacheandra
+"""
+
+import random
+import time
+from threading import Lock
+
+from .registry import per_location
+
+# the memcached copies of a hot key are key:hot1, key:hot2...
+REPLICA_SUFFIX = ':hot'
+
+def replica_key(key, n):
+    return '%s%s%d' % (key, REPLICA_SUFFIX, n)
+
+class CountMinSketch(object):
+    """
+    Estimates how many times each key has been counted in depth rows of width counters. An estimate is never
+    less than the real count, and is more only by the counts of keys that share all depth of its counters.
+    """
+
+    def __init__(self, width, depth):
+        self.width = width
+        self.depth = depth
+        self._rows = [[0] * width for i in range(depth)]
+
+    def _columns(self, key):
+        # one column per row from two hashes - good enough for a sketch, and cheaper than depth of them
+        h1 = hash(key)
+        h2 = hash((key,)) | 1
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, key, n=1):
+        """
+        Counts key n more times and returns its estimated count
+        """
+        estimate = None
+        for row, column in zip(self._rows, self._columns(key)):
+            row[column] += n
+            if estimate is None or row[column] < estimate:
+                estimate = row[column]
+        return estimate
+
+    def estimate(self, key):
+        return min(row[column] for row, column in zip(self._rows, self._columns(key)))
+
+    def halve(self):
+        for row in self._rows:
+            for i in range(self.width):
+                row[i] >>= 1
+
+_hot_keys = {}
+
+def get_hot_keys(location, replicas, threshold, window, sample_rate, max_keys, width, depth):
+    options = (replicas, threshold, window, sample_rate, max_keys, width, depth)
+    return per_location(_hot_keys, (location,) + options, lambda: HotKeys(*options))
+
+class HotKeys(object):
+    """
+    Counts sample_rate of the reads of each key in a CountMinSketch, and calls a key hot once it's been read
+    about threshold times in window seconds - at most max_keys keys are hot at once. Each window ends by
+    dropping the keys that weren't read threshold times and halving the counts, so a key stops being hot
+    a window or two after it cools down. A hot key has replicas copies in memcached under other keys, which
+    ketama spreads across the ring, and reads of it are spread across the key and its copies.
+
+    Threads count without a lock, so the odd count is lost - which doesn't matter for an estimate.
+    """
+
+    def __init__(self, replicas, threshold, window, sample_rate, max_keys, width, depth):
+        self.replicas = replicas
+        self.threshold = threshold
+        self.window = window
+        self.sample_rate = sample_rate
+        self.max_keys = max_keys
+        # what the sketch counts to for a key read threshold times
+        self._sampled_threshold = max(int(threshold * sample_rate), 1)
+        self._sketch = CountMinSketch(width, depth)
+        self._hot = frozenset()
+        self._lock = Lock()
+        self._window_end = time.time() + window
+
+    def _roll(self, now):
+        with self._lock:
+            if now < self._window_end:
+                return
+            self._window_end = now + self.window
+            self._hot = frozenset(key for key in self._hot if self._sketch.estimate(key) >= self._sampled_threshold)
+            self._sketch.halve()
+
+    def read(self, key):
+        """
+        Counts a read of key, and returns the key to read it from - key itself, or if it's hot one of its
+        copies at random
+        """
+        now = time.time()
+        if now >= self._window_end:
+            self._roll(now)
+        if random.random() < self.sample_rate:
+            if (self._sketch.add(key) >= self._sampled_threshold and key not in self._hot and
+                    len(self._hot) < self.max_keys):
+                with self._lock:
+                    self._hot = self._hot | frozenset([key])
+        if key in self._hot:
+            n = random.randint(0, self.replicas)
+            if n:
+                return replica_key(key, n)
+        return key
+
+    def replica_keys(self, key):
+        """
+        The keys of the copies of key, if it's hot
+        """
+        if key in self._hot:
+            return self.all_replica_keys(key)
+        return []
+
+    def all_replica_keys(self, key):
+        """
+        The keys key's copies would have - it may be hot in another process, which has made them
+        """
+        return [replica_key(key, n) for n in range(1, self.replicas + 1)]
+
+    def hot(self):
+        return self._hot
@@ -0,0 +1,183 @@
+"""
+Key transforms and key distribution for cacheandra
+"""
+
+import bisect
+import hashlib
+import struct
+
+class KeyTransform(object):
+    """
+    Turns the keys django makes into the keys used in memcached and cassandra. namespace, if given, goes in
+    front of every key. Keys longer than hash_threshold (0 for never) are replaced by the hex digest of the
+    whole key made with hash, which is any hashlib algorithm - the namespace stays in front, unhashed.
+    """
+
+    def __init__(self, namespace=None, hash_threshold=0, hash='md5'):
+        try:
+            hashlib.new(hash)
+        except ValueError:
+            raise ValueError("unknown key hash %r" % hash)
+        self.prefix = namespace + ':' if namespace else ''
+        self.hash_threshold = hash_threshold
+        self.hash = hash
+
+    def __call__(self, key):
+        key = self.prefix + key
+        if self.hash_threshold and len(key) > self.hash_threshold:
+            if isinstance(key, unicode):
+                key = key.encode('utf-8')
+            key = self.prefix + hashlib.new(self.hash, key).hexdigest()
+        return key
+
+"""
+Where keys end up - memcached servers as ketama would place them, and cassandra token ranges under the
+RandomPartitioner or the Murmur3Partitioner
+"""
+
+KETAMA_POINTS_PER_SERVER = 160
+
+def _ketama_points(digest):
+    return struct.unpack('<4I', digest)
+
+class KetamaRing(object):
+    def __init__(self, servers):
+        points = []
+        for server in servers:
+            for i in range(KETAMA_POINTS_PER_SERVER / 4):
+                for point in _ketama_points(hashlib.md5('%s-%d' % (server, i)).digest()):
+                    points.append((point, server))
+        points.sort()
+        self._points = [point for point, server in points]
+        self._servers = [server for point, server in points]
+
+    def server(self, key):
+        point = _ketama_points(hashlib.md5(key).digest())[0]
+        i = bisect.bisect(self._points, point)
+        return self._servers[i % len(self._servers)]
+
+RANDOM_PARTITIONER = 'org.apache.cassandra.dht.RandomPartitioner'
+MURMUR3_PARTITIONER = 'org.apache.cassandra.dht.Murmur3Partitioner'
+
+# the lowest and highest token of each partitioner's ring, by the class name describe_partitioner returns - a
+# token range (start, finish] is the tokens after start up to and including finish
+TOKEN_RINGS = {
+    RANDOM_PARTITIONER: (0, 2 ** 127),
+    MURMUR3_PARTITIONER: (-2 ** 63, 2 ** 63 - 1),
+}
+
+def token_ring(partitioner):
+    """
+    The (lowest, highest) tokens of partitioner - ValueError for a partitioner whose ring isn't known, such as
+    the order preserving ones
+    """
+    try:
+        return TOKEN_RINGS[partitioner]
+    except KeyError:
+        raise ValueError("unsupported partitioner %r, only %s are" % (partitioner, ' and '.join(sorted(TOKEN_RINGS))))
+
+def token_ranges(n, partitioner):
+    """
+    partitioner's token ring cut into n (start, finish) ranges of the same size
+    """
+    lowest, highest = token_ring(partitioner)
+    bounds = [lowest + i * (highest - lowest) // n for i in range(n + 1)]
+    return zip(bounds[:-1], bounds[1:])
+
+def cassandra_token(key, partitioner=RANDOM_PARTITIONER):
+    """
+    The token partitioner gives key
+    """
+    token_ring(partitioner)
+    if partitioner == MURMUR3_PARTITIONER:
+        return _murmur3_token(key)
+    # the md5 digest as a signed 128 bit integer, made positive
+    token = int(hashlib.md5(key).hexdigest(), 16)
+    if token >= 2 ** 127:
+        token -= 2 ** 128
+    return abs(token)
+
+_MASK64 = 2 ** 64 - 1
+_C1 = 0x87c37b91114253d5
+_C2 = 0x4cf5ad432745937f
+
+def _rotl64(x, r):
+    return ((x << r) | (x >> (64 - r))) & _MASK64
+
+def _fmix64(k):
+    k ^= k >> 33
+    k = (k * 0xff51afd7ed558ccd) & _MASK64
+    k ^= k >> 33
+    k = (k * 0xc4ceb9fe1a85ec53) & _MASK64
+    k ^= k >> 33
+    return k
+
+def _murmur3_token(key):
+    # the first half of cassandra's MurmurHash.hash3_x64_128 with seed 0, as a signed 64 bit integer
+    length = len(key)
+    nblocks = length // 16
+    h1 = h2 = 0
+    for k1, k2 in (struct.unpack_from('<QQ', key, i * 16) for i in range(nblocks)):
+        k1 = _rotl64((k1 * _C1) & _MASK64, 31)
+        h1 ^= (k1 * _C2) & _MASK64
+        h1 = (_rotl64(h1, 27) + h2) & _MASK64
+        h1 = (h1 * 5 + 0x52dce729) & _MASK64
+        k2 = _rotl64((k2 * _C2) & _MASK64, 33)
+        h2 ^= (k2 * _C1) & _MASK64
+        h2 = (_rotl64(h2, 31) + h1) & _MASK64
+        h2 = (h2 * 5 + 0x38495ab5) & _MASK64
+    # cassandra reads the tail as signed bytes, so bytes over 0x7f set every bit above their own
+    tail = [b - 256 if b > 127 else b for b in struct.unpack_from('%dB' % (length % 16), key, nblocks * 16)]
+    k1 = k2 = 0
+    for i in range(len(tail) - 1, 7, -1):
+        k2 ^= (tail[i] << ((i - 8) * 8)) & _MASK64
+    for i in range(min(len(tail), 8) - 1, -1, -1):
+        k1 ^= (tail[i] << (i * 8)) & _MASK64
+    if len(tail) > 8:
+        k2 = _rotl64((k2 * _C2) & _MASK64, 33)
+        h2 ^= (k2 * _C1) & _MASK64
+    if tail:
+        k1 = _rotl64((k1 * _C1) & _MASK64, 31)
+        h1 ^= (k1 * _C2) & _MASK64
+    h1 ^= length
+    h2 ^= length
+    h1 = (h1 + h2) & _MASK64
+    h2 = (h2 + h1) & _MASK64
+    h1 = (_fmix64(h1) + _fmix64(h2)) & _MASK64
+    token = h1 - 2 ** 64 if h1 >= 2 ** 63 else h1
+    # the lowest token is kept for the start of the ring
+    return token if token != -2 ** 63 else 2 ** 63 - 1
+
+def key_distribution(keys, servers=None, ranges=16, partitioner=RANDOM_PARTITIONER):
+    """
+    How keys spread out: a dict of 'memcached', the number of keys on each of servers, 'cassandra', the number
+    in each of ranges equal slices of partitioner's token ring, and 'keys', 'max_length', 'mean_length' and 'spread' -
+    the most keys on a server or in a range over the mean, for each tier
+    """
+    keys = [key.encode('utf-8') if isinstance(key, unicode) else key for key in keys]
+    report = {
+        'keys': len(keys),
+        'max_length': max(len(key) for key in keys) if keys else 0,
+        'mean_length': float(sum(len(key) for key in keys)) / len(keys) if keys else 0,
+        'spread': {},
+    }
+    if servers:
+        ring = KetamaRing(servers)
+        counts = dict((server, 0) for server in servers)
+        for key in keys:
+            counts[ring.server(key)] += 1
+        report['memcached'] = counts
+        report['spread']['memcached'] = _spread(counts.values())
+    if ranges:
+        lowest, highest = token_ring(partitioner)
+        counts = [0] * ranges
+        for key in keys:
+            token = cassandra_token(key, partitioner)
+            counts[min((token - lowest) * ranges // (highest - lowest), ranges - 1)] += 1
+        report['cassandra'] = counts
+        report['spread']['cassandra'] = _spread(counts)
+    return report
+
+def _spread(counts):
+    mean = float(sum(counts)) / len(counts)
+    return max(counts) / mean if mean else 0
@@ -0,0 +1,21 @@
+"""
+Deferred imports for cacheandra
+"""
+
+import sys
+import types
+
+from django.utils import importlib
+
+class LazyModule(types.ModuleType):
+    """
+    Stands in for the module called name, which is only imported when one of its attributes is first used.
+    After that its attributes are copied here, so using them costs the same as using the module itself.
+    """
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        module = sys.modules.get(self.__name__) or importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
@@ -0,0 +1,116 @@
+"""
+In-process cache tier for cacheandra
+"""
+
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+import cPickle as pickle
+
+from .registry import per_location
+
+_local_caches = {}
+
+def get_local_cache(location, max_entries, max_bytes):
+    return per_location(_local_caches, (location, max_entries, max_bytes),
+                        lambda: LocalCache(max_entries, max_bytes))
+
+class LocalCache(object):
+    """
+    A least recently used cache of pickled values, bounded by number of entries and their total size in
+    bytes, where every entry expires after its own timeout. Values are pickled on the way in, as with
+    django's locmem cache, so callers can't change what's cached by mutating what they got back.
+
+    The store is thrown away when the process forks, so every process has its own.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        # key -> (expiry, pickled value), least recently used first
+        self._store = OrderedDict()
+        self._bytes = 0
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _pop(self, key):
+        entry = self._store.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[1])
+        return entry
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            self._check_pid()
+            entry = self._pop(key)
+            if entry is None or entry[0] <= now:
+                self.misses += 1
+                return default
+            # put it back as the most recently used
+            self._store[key] = entry
+            self._bytes += len(entry[1])
+            self.hits += 1
+        return pickle.loads(entry[1])
+
+    def get_many(self, keys):
+        ret = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                ret[key] = value
+        return ret
+
+    def set(self, key, value, timeout):
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(pickled) > self.max_bytes:
+            self.delete(key)
+            return
+        with self._lock:
+            self._check_pid()
+            self._pop(key)
+            self._store[key] = (time.time() + timeout, pickled)
+            self._bytes += len(pickled)
+            while len(self._store) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted) = self._store.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def set_many(self, data, timeout):
+        for key, value in data.items():
+            self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            self._check_pid()
+            self._pop(key)
+
+    def delete_many(self, keys):
+        with self._lock:
+            self._check_pid()
+            for key in keys:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+
+    def stats(self):
+        with self._lock:
+            self._check_pid()
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._store),
+                'bytes': self._bytes,
+            }
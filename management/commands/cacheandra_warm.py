@@ -0,0 +1,30 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cacheandra.warmup import warm
+
+class Command(BaseCommand):
+    help = "Copies values and counters from cassandra into memcached, to fill a new or restarted memcached ring"
+    option_list = BaseCommand.option_list + (
+        make_option('--cache', default='default', help='the cache alias in CACHES'),
+        make_option('--prefix', default=None, help='only keys that start with this, as stored, e.g. :1:user'),
+        make_option('--keys', default=None, help='only the cache keys in this file, one a line'),
+        make_option('--processes', type='int', default=4, help='worker processes reading the token ring'),
+        make_option('--batch-size', type='int', default=100, help='keys written to memcached at a time'),
+        make_option('--rate', type='int', default=0, help='most keys written a second, 0 for no limit'),
+    )
+
+    def handle(self, *args, **options):
+        keys = None
+        if options['keys']:
+            try:
+                with open(options['keys']) as f:
+                    keys = [line.strip() for line in f if line.strip()]
+            except IOError as e:
+                raise CommandError("Can't read keys from %s: %s" % (options['keys'], e))
+        start = time.time()
+        n = warm(options['cache'], prefix=options['prefix'], keys=keys, processes=options['processes'],
+                 batch_size=options['batch_size'], rate=options['rate'])
+        self.stdout.write("Warmed %d keys in %.1fs\n" % (n, time.time() - start))
@@ -0,0 +1,167 @@
+"""
+Metrics for cacheandra
+
+A sink is told about counts with incr(name, count) and latencies with timing(name, seconds). Names are dotted,
+e.g. op.get for the latency of get, get.memcached_hit, get.cassandra_hit, get.miss, backfill,
+memcached.retry, memcached.error.<exception>, cassandra.error.<exception> and cassandra.bytes_written.
+"""
+
+import bisect
+import functools
+import socket
+import time
+from threading import Lock
+
+from django.dispatch import Signal
+from django.utils import importlib
+
+class Metrics(object):
+    """
+    The sink used when metrics are off, every call does nothing. Other sinks subclass it.
+    """
+
+    enabled = False
+
+    def __init__(self, options=None):
+        pass
+
+    def incr(self, name, count=1):
+        pass
+
+    def timing(self, name, seconds):
+        pass
+
+    def snapshot(self):
+        return None
+
+    def timed(self, name, func):
+        """
+        Wraps func to report how long each call takes as the timing op.<name>
+        """
+        name = 'op.' + name
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.timing(name, time.time() - start)
+        return wrapper
+
+# upper bounds of the latency histogram buckets, in milliseconds
+HISTOGRAM_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+
+class MemoryMetrics(Metrics):
+    """
+    Keeps counts and latency histograms in memory - snapshot() returns them
+    """
+
+    enabled = True
+
+    def __init__(self, options=None):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+
+    def incr(self, name, count=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + count
+
+    def timing(self, name, seconds):
+        ms = seconds * 1000
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = [0] * len(HISTOGRAM_BUCKETS) + [0.0]
+            histogram[bisect.bisect_left(HISTOGRAM_BUCKETS, ms)] += 1
+            histogram[-1] += ms
+
+    def snapshot(self):
+        """
+        A dict of counters, name -> count, and timings, name -> dict of count, mean and the bucket bounds
+        p50 and p99 fall in, all in milliseconds
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict((name, list(h)) for name, h in self._histograms.items())
+        timings = {}
+        for name, histogram in histograms.items():
+            buckets, total = histogram[:-1], histogram[-1]
+            count = sum(buckets)
+            timings[name] = {
+                'count': count,
+                'mean': total / count,
+                'p50': self._percentile(buckets, count, 0.5),
+                'p99': self._percentile(buckets, count, 0.99),
+            }
+        return {'counters': counters, 'timings': timings}
+
+    def _percentile(self, buckets, count, fraction):
+        seen = 0
+        for bound, n in zip(HISTOGRAM_BUCKETS, buckets):
+            seen += n
+            if seen >= count * fraction:
+                return bound
+        return HISTOGRAM_BUCKETS[-1]
+
+class StatsdMetrics(Metrics):
+    """
+    Sends counts and timings to statsd over UDP, at statsd_host:statsd_port with metrics_prefix on every name
+    """
+
+    enabled = True
+
+    def __init__(self, options=None):
+        options = options or {}
+        self.address = (options.get('statsd_host', '127.0.0.1'), options.get('statsd_port', 8125))
+        self.prefix = options.get('metrics_prefix', 'cacheandra')
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, data):
+        try:
+            self._socket.sendto(data, self.address)
+        except socket.error:
+            pass
+
+    def incr(self, name, count=1):
+        self._send('%s.%s:%d|c' % (self.prefix, name, count))
+
+    def timing(self, name, seconds):
+        self._send('%s.%s:%.3f|ms' % (self.prefix, name, seconds * 1000))
+
+metric = Signal(providing_args=['name', 'kind', 'value'])
+
+class SignalMetrics(Metrics):
+    """
+    Sends the django signal metric, with kind 'count' or 'timing', for every count and timing
+    """
+
+    enabled = True
+
+    def incr(self, name, count=1):
+        metric.send(sender=self.__class__, name=name, kind='count', value=count)
+
+    def timing(self, name, seconds):
+        metric.send(sender=self.__class__, name=name, kind='timing', value=seconds)
+
+SINKS = {
+    'memory': MemoryMetrics,
+    'statsd': StatsdMetrics,
+    'signal': SignalMetrics,
+}
+
+def get_metrics(sink, options):
+    """
+    The sink called 'memory', 'statsd' or 'signal', or the Metrics subclass at the dotted path sink,
+    made with options. None gives the sink that does nothing.
+    """
+    if sink is None:
+        return Metrics(options)
+    if sink in SINKS:
+        return SINKS[sink](options)
+    module, attr = sink.rsplit('.', 1)
+    return getattr(importlib.import_module(module), attr)(options)
@@ -0,0 +1,96 @@
+"""
+Retry and circuit breaker policies for memcached calls
+"""
+
+import logging
+import random
+import time
+from threading import Lock
+
+from .registry import per_location
+
+logger = logging.getLogger(__name__)
+
+class RetryPolicy(object):
+    """
+    How a memcached call is retried when its server is disabled until a timed retry. There are at most
+    max_attempts calls in all, each retry waits a random time up to a delay that doubles from delay to
+    max_delay, and no retry is made that would finish waiting after deadline seconds.
+    """
+
+    def __init__(self, max_attempts=3, delay=0.05, max_delay=0.2, deadline=0.5):
+        self.max_attempts = max_attempts
+        self.delay = delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def delays(self):
+        """
+        Yields how long to sleep before each retry, starting the deadline clock now
+        """
+        deadline = time.time() + self.deadline
+        delay = self.delay
+        for attempt in range(1, self.max_attempts):
+            sleep = random.uniform(0, delay)
+            if time.time() + sleep > deadline:
+                return
+            yield sleep
+            delay = min(delay * 2, self.max_delay)
+
+_breakers = {}
+
+def get_circuit_breaker(name, threshold, reset_timeout):
+    # one per memcached ring rather than per cache location
+    return per_location(_breakers, (name, threshold, reset_timeout),
+                        lambda: CircuitBreaker(name, threshold, reset_timeout))
+
+class CircuitBreaker(object):
+    """
+    Stops calls to memcached after threshold calls in a row have failed. Once open, calls are refused
+    for reset_timeout seconds, then a single trial call is let through - if it succeeds the breaker closes,
+    if not it stays open for another reset_timeout. Changes of state are logged, individual calls aren't.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, threshold=5, reset_timeout=5):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._lock = Lock()
+
+    def is_open(self):
+        return self.state != self.CLOSED
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        with self._lock:
+            if self.state == self.OPEN and time.time() - self._opened_at >= self.reset_timeout:
+                self._change(self.HALF_OPEN)
+                return True
+            return False
+
+    def success(self):
+        if self.state == self.CLOSED and not self._failures:
+            return
+        with self._lock:
+            self._failures = 0
+            if self.state != self.CLOSED:
+                self._change(self.CLOSED)
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self._failures >= self.threshold):
+                self._opened_at = time.time()
+                self._change(self.OPEN)
+
+    def _change(self, state):
+        logger.warning("Cacheandra: memcached circuit breaker for %s %s -> %s", self.name, self.state, state)
+        self.state = state
@@ -0,0 +1,19 @@
+"""
+Per process state for cacheandra
+"""
+
+from threading import Lock
+
+_lock = Lock()
+
+def per_location(registry, location, factory):
+    """
+    The object in registry for location, made with factory() the first time it's asked for - so there's one per
+    process, shared by every CacheBackend instance asking for the same location. Callers put the options that
+    change what factory makes in location, so that backends which differ in them don't share.
+    """
+    with _lock:
+        obj = registry.get(location)
+        if obj is None:
+            obj = registry[location] = factory()
+        return obj
@@ -0,0 +1,135 @@
+"""
+Serialization of the values cacheandra stores in cassandra
+"""
+
+import marshal
+import zlib
+
+import cPickle as pickle
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    from lz4 import block as lz4
+except ImportError:
+    try:
+        import lz4
+    except ImportError:
+        lz4 = None
+
+"""
+Serialized values start with a header byte giving the format in the low bits and the compression in the high
+bits. Values written before there was a header are protocol 0 pickles, and no pickle opcode is a valid header,
+so anything without a header is loaded as a plain pickle.
+"""
+
+FORMAT_PICKLE = 0x01
+FORMAT_MARSHAL = 0x02
+FORMAT_MSGPACK = 0x03
+FORMAT_MASK = 0x0f
+
+COMPRESSION_NONE = 0x00
+COMPRESSION_ZLIB = 0x10
+COMPRESSION_LZ4 = 0x20
+COMPRESSION_MASK = 0xf0
+
+FORMATS = {
+    'pickle': FORMAT_PICKLE,
+    'marshal': FORMAT_MARSHAL,
+    'msgpack': FORMAT_MSGPACK,
+}
+
+COMPRESSIONS = {
+    'zlib': COMPRESSION_ZLIB,
+    'lz4': COMPRESSION_LZ4,
+}
+
+def _pickle_dumps(value):
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+def _msgpack_dumps(value):
+    return msgpack.packb(value, use_bin_type=False)
+
+def _msgpack_loads(data):
+    return msgpack.unpackb(data, use_list=True)
+
+_dumps = {
+    FORMAT_PICKLE: _pickle_dumps,
+    FORMAT_MARSHAL: marshal.dumps,
+    FORMAT_MSGPACK: _msgpack_dumps,
+}
+
+_loads = {
+    FORMAT_PICKLE: pickle.loads,
+    FORMAT_MARSHAL: marshal.loads,
+    FORMAT_MSGPACK: _msgpack_loads,
+}
+
+def _lz4_compress(data, level):
+    return lz4.compress(data)
+
+def _lz4_decompress(data):
+    return lz4.decompress(data)
+
+_compress = {
+    COMPRESSION_ZLIB: zlib.compress,
+    COMPRESSION_LZ4: _lz4_compress,
+}
+
+_decompress = {
+    COMPRESSION_ZLIB: zlib.decompress,
+    COMPRESSION_LZ4: _lz4_decompress,
+}
+
+class Serializer(object):
+    """
+    Turns values into strings for cassandra and back again.
+
+    format is 'pickle' (highest protocol), 'marshal' or 'msgpack'. marshal and msgpack only handle plain
+    types, anything else is pickled instead. msgpack gives back lists for tuples.
+    Values that serialize to at least min_compress_len bytes are compressed with 'zlib' or 'lz4', as long
+    as that makes them smaller - 0 turns compression off, like pylibmc's min_compress_len.
+    """
+
+    def __init__(self, format='pickle', compression='zlib', min_compress_len=0, compress_level=6):
+        if format not in FORMATS:
+            raise ValueError("unknown serializer format %r" % format)
+        if format == 'msgpack' and msgpack is None:
+            raise ValueError("the msgpack serializer needs msgpack installed")
+        if compression not in COMPRESSIONS:
+            raise ValueError("unknown compression %r" % compression)
+        if compression == 'lz4' and lz4 is None:
+            raise ValueError("lz4 compression needs lz4 installed")
+        self.format = FORMATS[format]
+        self.compression = COMPRESSIONS[compression]
+        self.min_compress_len = min_compress_len
+        self.compress_level = compress_level
+
+    def dumps(self, value):
+        format = self.format
+        try:
+            data = _dumps[format](value)
+        except (ValueError, TypeError):
+            # not a plain type
+            format = FORMAT_PICKLE
+            data = _pickle_dumps(value)
+        if self.min_compress_len and len(data) >= self.min_compress_len:
+            compressed = _compress[self.compression](data, self.compress_level)
+            if len(compressed) < len(data):
+                return chr(format | self.compression) + compressed
+        return chr(format) + data
+
+    def loads(self, data):
+        header = ord(data[0]) if data else 0
+        format = header & FORMAT_MASK
+        compression = header & COMPRESSION_MASK
+        if format not in _loads or (compression and compression not in _decompress):
+            # written before there were headers
+            return pickle.loads(data)
+        data = data[1:]
+        if compression:
+            data = _decompress[compression](data)
+        return _loads[format](data)
@@ -11,9 +11,34 @@ from django.core.cache import get_cache
 
 import mock
 
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import _pylibmc
 import pycassa
 from pycassa.system_manager import *
 
+from . import bench, cacheandra
+from .asyncclient import AsyncCacheClient
+from .cacheandra import LARGE_MARKER, REFRESH_SUFFIX
+from .concurrency import SingleFlight
+from .hotkeys import CountMinSketch, replica_key
+from .keys import MURMUR3_PARTITIONER, KeyTransform, cassandra_token, key_distribution
+from .lazy import LazyModule
+from .localcache import LocalCache
+from .metrics import MemoryMetrics
+from .policies import CircuitBreaker, RetryPolicy
+from .serializers import Serializer
+from .warmup import token_ranges
+from .writebehind import CounterAggregator, WriteBehindQueue
+
+import cPickle as pickle
+
 class CacheTests(TestCase):
         
     def test_cache_only(self):
@@ -57,6 +82,21 @@ class CacheTests(TestCase):
         value = cache.get('testcounter')
         self.assertEquals(value,None)
 
+    def test_get_many_partial_miss(self):
+        cache = get_cache('cacheandra.cacheandra.CacheBackend', **{
+            'LOCATION': '127.0.0.1:11211',
+            'CASSANDRA': '127.0.0.1',
+        })
+        cache.clear()
+        cache.set_many({'key1':'value1','key2':'value2','key3':3})
+        # lose some of the keys from memcached only, as if a server had dropped out of the ring
+        cache._cache.delete_multi([cache.make_key('key2'),cache.make_key('key3')])
+        values = cache.get_many(['key1','key2','key3','key4'])
+        self.assertEquals(values,{'key1':'value1','key2':'value2','key3':3})
+        # and the missing keys have been put back into memcached
+        value = cache._cache.get(cache.make_key('key2'))
+        self.assertEquals(value,'value2')
+
     def cache_tests(self,cache):
         # perform a consistent set of tests on all cache configurations
         cache.clear()
@@ -122,5 +162,797 @@ class CacheTests(TestCase):
         cache.delete('testcounter')
         value = cache.get('testcounter')
         self.assertEquals(value,None)
-        
-        
\ No newline at end of file
+
+class AsyncCacheClientTests(TestCase):
+
+    def test_async_client(self):
+        client = AsyncCacheClient(get_cache('cacheandra.cacheandra.CacheBackend', **{
+            'LOCATION': '127.0.0.1:11211',
+            'CASSANDRA': '127.0.0.1',
+        }))
+        client.aset('asynckey', 'value').get(5)
+        self.assertEquals(client.aget('asynckey').get(5), 'value')
+        client.aset_many({'asynckey1': 1, 'asynckey2': 'two'}).get(5)
+        self.assertEquals(client.aget_many(['asynckey1', 'asynckey2', 'missing']).get(5),
+                          {'asynckey1': 1, 'asynckey2': 'two'})
+        self.assertEquals(client.aincr('asynckey1').get(5), 2)
+        client.adelete('asynckey').get(5)
+        self.assertEquals(client.aget('asynckey', 'default').get(5), 'default')
+
+    def test_async_client_on_fakes(self):
+        for tier in bench.TIERS:
+            client = AsyncCacheClient(bench.make_backend(tier))
+            client.aset('asynckey', 'value').get(5)
+            self.assertEquals(client.aget('asynckey').get(5), 'value')
+            client.aset_many({'asynckey1': 'one', 'asynckey2': 'two'}).get(5)
+            self.assertEquals(client.aget_many(['asynckey1', 'asynckey2', 'missing']).get(5),
+                              {'asynckey1': 'one', 'asynckey2': 'two'})
+            client.aset('asynccounter', 1).get(5)
+            self.assertEquals(client.aincr('asynccounter').get(5), 2)
+            self.assertEquals(client.adecr('asynccounter', 2).get(5), 0)
+            client.adelete('asynckey').get(5)
+            self.assertEquals(client.aget('asynckey', 'default').get(5), 'default')
+
+class LocalCacheTests(TestCase):
+
+    def test_expiry(self):
+        cache = LocalCache(10, 1024)
+        cache.set('key', 'value', 60)
+        self.assertEquals(cache.get('key'), 'value')
+        cache.set('key', 'value', -1)
+        self.assertEquals(cache.get('key'), None)
+        self.assertEquals(cache.stats()['hits'], 1)
+        self.assertEquals(cache.stats()['misses'], 1)
+
+    def test_bounds(self):
+        cache = LocalCache(2, 1024)
+        cache.set('key1', 'value1', 60)
+        cache.set('key2', 'value2', 60)
+        cache.get('key1')
+        cache.set('key3', 'value3', 60)
+        # key2 was the least recently used
+        self.assertEquals(cache.get_many(['key1','key2','key3']), {'key1':'value1','key3':'value3'})
+        cache.set('key4', 'x'*2048, 60)
+        self.assertEquals(cache.get('key4'), None)
+        self.assertTrue(cache.stats()['bytes'] <= 1024)
+
+    def test_values_are_copies(self):
+        cache = LocalCache(10, 1024)
+        value = [1, 2]
+        cache.set('key', value, 60)
+        value.append(3)
+        cache.get('key').append(4)
+        self.assertEquals(cache.get('key'), [1, 2])
+
+class SingleFlightTests(TestCase):
+
+    def test_concurrent_calls_share_one_call(self):
+        flight = SingleFlight()
+        calls = []
+        def slow(key):
+            calls.append(key)
+            time.sleep(0.1)
+            return key.upper()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do('key', slow, 'key'))) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals(calls, ['key'])
+        self.assertEquals(results, ['KEY']*5)
+        self.assertEquals(flight.in_flight(), 0)
+
+class PolicyTests(TestCase):
+
+    def test_retry_policy_is_bounded(self):
+        delays = list(RetryPolicy(max_attempts=3, delay=0.01, max_delay=0.02, deadline=1).delays())
+        self.assertEquals(len(delays), 2)
+        self.assertTrue(all(0 <= d <= 0.02 for d in delays))
+        self.assertEquals(list(RetryPolicy(max_attempts=10, delay=1, max_delay=1, deadline=0).delays()), [])
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker('test', threshold=2, reset_timeout=0.05)
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        # one trial call once the timeout has passed
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.success()
+        self.assertEquals(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+
+    def test_breaker_opens_on_unreachable_memcached(self):
+        cache = get_cache('cacheandra.cacheandra.CacheBackend', **{
+            'LOCATION': '127.0.0.1:1',
+            'OPTIONS': dict(breaker_threshold=2, breaker_reset_timeout=60, retry_delay=0.001, retry_max_delay=0.001),
+        })
+        with mock.patch('cacheandra.cacheandra.logger') as logger:
+            for i in range(10):
+                self.assertEquals(cache.get('key'), None)
+        self.assertEquals(cache._breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(logger.warning.called)
+
+    def test_timed_out_incr_not_retried(self):
+        def timed_out(func):
+            # the server makes the call, but the answer doesn't come back in time
+            def call(*args):
+                func(*args)
+                raise _pylibmc.MemcachedError('error 31 from memcached_%s(:1:counter): (0x0) A TIMEOUT OCCURRED,'
+                                              '  host: 127.0.0.1:1 -> libmemcached/io.cc:254' % func.__name__)
+            call.__name__ = func.__name__
+            return call
+        cache = bench.make_backend(bench.MEMCACHED, {'retry_delay': 0.001, 'retry_max_delay': 0.001})
+        memcached = cache._cache
+        cache.set('counter', 0)
+        with mock.patch.object(memcached, 'incr', timed_out(memcached.incr)):
+            self.assertRaises(ValueError, cache.incr, 'counter')
+        self.assertEquals(cache.get('counter'), 1)
+        with mock.patch.object(memcached, 'add', timed_out(memcached.add)):
+            self.assertEquals(cache.add('key', 'value'), False)
+        self.assertEquals(cache.get('key'), 'value')
+        # cassandra is told once, and its count is the answer
+        cache = bench.make_backend(bench.DUAL, {'retry_delay': 0.001, 'retry_max_delay': 0.001})
+        memcached = cache._cache
+        cache.set('counter', 0)
+        with mock.patch.object(memcached, 'incr', timed_out(memcached.incr)):
+            self.assertEquals(cache.incr('counter'), 1)
+        self.assertEquals(memcached.get(cache.make_key('counter')), 1)
+        memcached.flush_all()
+        self.assertEquals(cache.get('counter'), 1)
+
+    def test_timed_out_get_retried(self):
+        cache = bench.make_backend(bench.MEMCACHED, {'retry_delay': 0.001, 'retry_max_delay': 0.001})
+        memcached = cache._cache
+        cache.set('key', 'value')
+        errors = [_pylibmc.MemcachedError('error 31 from memcached_get(:1:key): (0x0) A TIMEOUT OCCURRED')]
+        get = memcached.get
+        def flaky_get(key):
+            if errors:
+                raise errors.pop()
+            return get(key)
+        flaky_get.__name__ = 'get'
+        with mock.patch.object(memcached, 'get', flaky_get):
+            self.assertEquals(cache.get('key'), 'value')
+
+class WriteBehindTests(TestCase):
+
+    def test_write_behind(self):
+        cache = bench.make_backend(bench.DUAL, {'write_behind': True})
+        cache.set('key', 'value')
+        cache.set_many({'key1': 'one', 'counter': 5})
+        self.assertEquals(cache.get_many(['key', 'key1', 'counter']), {'key': 'value', 'key1': 'one', 'counter': 5})
+        cache._write_behind.flush(5)
+        cache._cache.flush_all()
+        self.assertEquals(cache.get_many(['key', 'key1', 'counter']), {'key': 'value', 'key1': 'one', 'counter': 5})
+        self.assertEquals(cache.incr('counter'), 6)
+
+    def test_writes_made_by_their_own_function(self):
+        queue = WriteBehindQueue(batch_size=10)
+        first, second = [], []
+        def write_first(writes):
+            first.extend(writes)
+        def write_second(writes):
+            second.extend(writes)
+        queue.put('key1', 'one', write_first)
+        queue.put('key2', 'two', write_second)
+        queue.put('key3', 'three', write_first)
+        self.assertTrue(queue.flush(5))
+        self.assertEquals(sorted(first), ['one', 'three'])
+        self.assertEquals(second, ['two'])
+
+    def test_close_keeps_the_queued_writes(self):
+        cache = bench.make_backend(bench.DUAL, {'write_behind': True, 'write_behind_workers': 1,
+                                                'write_behind_batch_size': 1, 'write_behind_close_timeout': 0.05})
+        release = threading.Event()
+        write = cache._write_behind_batch
+        def slow(writes):
+            release.wait(5)
+            write(writes)
+        cache._write_behind_batch = slow
+        cache.set('key1', 'one')
+        cache.set('key2', 'two')
+        start = time.time()
+        cache.close()
+        self.assertTrue(time.time() - start < 1)
+        stats = cache.write_behind_stats()
+        self.assertEquals((stats['depth'], stats['writing'], stats['written']), (1, 1, 0))
+        # flush() writes what's queued itself, and then waits for the worker
+        threading.Timer(0.2, release.set).start()
+        cache.flush()
+        self.assertEquals(cache.write_behind_stats()['written'], 2)
+        cache._cache.flush_all()
+        self.assertEquals(cache.get_many(['key1', 'key2']), {'key1': 'one', 'key2': 'two'})
+
+    def test_counter_deltas_made_by_their_own_function(self):
+        aggregator = CounterAggregator(60)
+        first, second = [], []
+        def write_first(deltas):
+            first.append(deltas)
+        def write_second(deltas):
+            second.append(deltas)
+        aggregator.add('key', 1, write_first)
+        aggregator.add('key', 2, write_second)
+        aggregator.add('other', 3, write_first)
+        self.assertEquals(aggregator.take('key'), 3)
+        aggregator.flush()
+        self.assertEquals(first, [{'other': 3}])
+        self.assertEquals(second, [])
+
+class SerializerTests(TestCase):
+
+    def test_round_trip(self):
+        for serializer in (Serializer('pickle'), Serializer('marshal', min_compress_len=100)):
+            for value in (1, 'value', {'key':[1, 2]}, 'x'*1000, CacheTests):
+                self.assertEquals(serializer.loads(serializer.dumps(value)), value)
+
+    def test_compression(self):
+        serializer = Serializer('pickle', min_compress_len=100)
+        self.assertTrue(len(serializer.dumps('x'*1000)) < 100)
+        self.assertEquals(serializer.loads(serializer.dumps('x'*1000)), 'x'*1000)
+
+    def test_values_without_header(self):
+        serializer = Serializer('marshal')
+        for value in (1, 'value', u'value', {'key':[1, (2, 3)]}, None, 1.5):
+            self.assertEquals(serializer.loads(pickle.dumps(value)), value)
+
+class MetricsTests(TestCase):
+
+    def test_memory_metrics(self):
+        metrics = MemoryMetrics()
+        metrics.incr('get.miss')
+        metrics.incr('get.miss', 2)
+        get = metrics.timed('get', lambda key: key)
+        self.assertEquals(get('key'), 'key')
+        metrics.timing('op.get', 0.02)
+        snapshot = metrics.snapshot()
+        self.assertEquals(snapshot['counters'], {'get.miss': 3})
+        self.assertEquals(snapshot['timings']['op.get']['count'], 2)
+        self.assertEquals(snapshot['timings']['op.get']['p99'], 25)
+
+class BenchTests(TestCase):
+
+    def test_fakes(self):
+        for tier in bench.TIERS:
+            cache = bench.make_backend(tier)
+            cache.set('key', 'value')
+            self.assertEquals(cache.get('key'), 'value')
+            self.assertEquals(cache.get_many(['key', 'missing']), {'key': 'value'})
+            cache.set('counter', 1)
+            self.assertEquals(cache.incr('counter'), 2)
+            cache.delete('key')
+            self.assertEquals(cache.get('key'), None)
+            cache.set_many({'key1': 'value', 'counter': 3})
+            cache.delete_many(['key1', 'counter'])
+            self.assertEquals(cache.get_many(['key1', 'counter']), {})
+
+    def test_run_benchmarks(self):
+        benchmarks = [bench.Benchmark('get', bench.DUAL, hit_ratio=0.5), bench.Benchmark('set_many', bench.CASSANDRA, keys=10)]
+        report = bench.run_benchmarks(benchmarks, iterations=20)
+        self.assertEquals(sorted(report), sorted(b.name for b in benchmarks))
+        for result in report.values():
+            self.assertTrue(result['p50'] <= result['p99'])
+            self.assertTrue(result['ops'] > 0)
+
+    def test_import_leaves_settings_alone(self):
+        # importing bench mustn't set up settings of its own in place of the settings module
+        script = 'from %s import bench\nfrom django.conf import settings\nprint settings.SETTINGS_MODULE' % bench.__package__
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(path or os.getcwd() for path in sys.path))
+        output = subprocess.check_output([sys.executable, '-c', script], env=env)
+        self.assertEquals(output.strip(), os.environ['DJANGO_SETTINGS_MODULE'])
+
+    def test_run_overhead(self):
+        report = bench.run_overhead(iterations=10)
+        self.assertEquals(sorted(report), sorted('overhead/%s/%s' % (op, name) for op in ('get', 'set', 'get_many', 'incr')
+                                                 for name in ('cacheandra', 'plain')))
+
+class NegativeCachingTests(TestCase):
+
+    def test_negative_caching(self):
+        cassandra = bench.Latency()
+        cache = bench.make_backend(bench.DUAL, {'negative_timeout': 60}, cassandra_latency=cassandra)
+        self.assertEquals(cache.get('missing', 'default'), 'default')
+        calls = cassandra.calls
+        self.assertEquals(cache.get('missing', 'default'), 'default')
+        self.assertEquals(cache.get_many(['missing']), {})
+        self.assertEquals(cassandra.calls, calls)
+        self.assertEquals(cache.get_many(['missing2']), {})
+        self.assertEquals(cache.get('missing2'), None)
+        self.assertTrue(cache.add('missing', 'value'))
+        self.assertEquals(cache.get('missing'), 'value')
+        cache.set('missing2', 'value')
+        self.assertEquals(cache.get_many(['missing2']), {'missing2': 'value'})
+
+class WarmTests(TestCase):
+
+    def test_warm(self):
+        cache = bench.make_backend(bench.DUAL)
+        cache.set_many({'user1': 'one', 'user2': 'two', 'other': 'three'})
+        cache.set('usercount', 5)
+        cache.incr('usercount')
+        memcached = cache._cache
+        memcached.flush_all()
+        self.assertEquals(cache.warm(prefix=cache.make_key('user'), batch_size=2), 3)
+        self.assertEquals(memcached.get_multi([cache.make_key(k) for k in ('user1', 'user2', 'usercount', 'other')]),
+                          {cache.make_key('user1'): 'one', cache.make_key('user2'): 'two',
+                           cache.make_key('usercount'): 6})
+        memcached.flush_all()
+        self.assertEquals(sum(cache.warm(start, finish) for start, finish in token_ranges(4, cache.partitioner())), 4)
+        memcached.flush_all()
+        self.assertEquals(cache.warm(keys=['other', 'missing']), 1)
+        self.assertEquals(memcached.get(cache.make_key('other')), 'three')
+
+    def test_partitioners(self):
+        cache = bench.make_backend(bench.DUAL, partitioner=MURMUR3_PARTITIONER)
+        self.assertEquals(cache.partitioner(), MURMUR3_PARTITIONER)
+        cache.set_many(dict(('key%d' % i, i) for i in range(100)))
+        cache._cache.flush_all()
+        ranges = token_ranges(8, cache.partitioner())
+        self.assertEquals(ranges[0][0], -2 ** 63)
+        self.assertEquals([cache.warm(start, finish) for start, finish in ranges].count(0), 0)
+        self.assertEquals(cache.get_many(['key%d' % i for i in range(100)], tier='memcached_only'),
+                          dict(('key%d' % i, i) for i in range(100)))
+        cache = bench.make_backend(bench.DUAL, {'partitioner': 'org.apache.cassandra.dht.ByteOrderedPartitioner'})
+        self.assertRaises(ValueError, cache.partitioner)
+        self.assertRaises(ValueError, token_ranges, 4, 'org.apache.cassandra.dht.ByteOrderedPartitioner')
+        self.assertEquals(bench.make_backend(bench.MEMCACHED).key_distribution(['key'])['keys'], 1)
+
+class TierTests(TestCase):
+
+    def test_tiers(self):
+        cache = bench.make_backend(bench.DUAL)
+        memcached = cache._cache
+        cache.set('hot', 'value', tier='memcached_only')
+        self.assertEquals(cache.get('hot', tier='cassandra_only'), None)
+        self.assertEquals(cache.get('hot'), 'value')
+        cache.set('blob', 'old')
+        cache.set_many({'blob': 'value', 'blob2': 'value2'}, tier='cassandra_only')
+        self.assertEquals(memcached.get_multi([cache.make_key('blob'), cache.make_key('blob2')]), {})
+        self.assertEquals(cache.get_many(['blob', 'blob2'], tier='cassandra_only'), {'blob': 'value', 'blob2': 'value2'})
+        self.assertEquals(memcached.get(cache.make_key('blob')), None)
+        self.assertEquals(cache.get('blob'), 'value')
+        self.assertEquals(memcached.get(cache.make_key('blob')), 'value')
+        self.assertRaises(ValueError, cache.get, 'blob', tier='nowhere')
+
+class GenerationTests(TestCase):
+
+    def test_generations(self):
+        for tier in bench.TIERS:
+            cache = bench.make_backend(tier, {'generations': True, 'generation_namespaces': ['tenant1', 'tenant2']})
+            cache.set_many({'tenant1:key': 'one', 'tenant2:key': 'two', 'key': 'three'})
+            cache.clear_prefix('tenant1:')
+            self.assertEquals(cache.get_many(['tenant1:key', 'tenant2:key', 'key']), {'tenant2:key': 'two', 'key': 'three'})
+            cache.set('tenant1:key', 'new')
+            self.assertEquals(cache.get('tenant1:key'), 'new')
+            cache.clear()
+            self.assertEquals(cache.get_many(['tenant1:key', 'tenant2:key', 'key']), {})
+            self.assertRaises(ValueError, bench.make_backend(tier).clear_prefix, 'tenant1')
+            self.assertRaises(ValueError, cache.clear_prefix, 'tenant3')
+
+    def test_other_prefixes_not_namespaces(self):
+        memcached = bench.Latency(0)
+        cache = bench.make_backend(bench.MEMCACHED, {'generations': True, 'generation_namespaces': ['tenant1']},
+                                   memcached_latency=memcached)
+        cache.get('key')
+        calls = memcached.calls
+        for i in range(1000):
+            cache.set('user%d:key' % i, i)
+        self.assertEquals(cache.get('user7:key'), 7)
+        self.assertEquals(cache._generations._generations.keys(), [None])
+        # no generation lookups, one set and one get for each key
+        self.assertEquals(memcached.calls - calls, 1001)
+        cache.get('tenant1:key')
+        self.assertEquals(sorted(cache._generations._generations.keys()), [None, 'tenant1'])
+
+class GetOrSetTests(TestCase):
+
+    def test_get_or_set(self):
+        for tier in bench.TIERS:
+            cache = bench.make_backend(tier)
+            calls = []
+            def compute():
+                calls.append(1)
+                return len(calls)
+            self.assertEquals(cache.get_or_set('soft', compute, 60, soft_timeout=0), 1)
+            self.assertEquals(cache.get('soft'), 1)
+            self.assertEquals(cache.get_many(['soft']), {'soft': 1})
+            # stale, so handed back while it's refreshed
+            self.assertEquals(cache.get_or_set('soft', compute, 60, soft_timeout=0), 1)
+            deadline = time.time() + 5
+            while (cache._refresher.running() or len(calls) < 2) and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEquals(cache.get('soft'), 2)
+            self.assertEquals(cache.get_or_set('fresh', compute, 60), 3)
+            self.assertEquals(cache.get_or_set('fresh', compute, 60), 3)
+            cache.set('plain', 'value')
+            self.assertEquals(cache.get_or_set('plain', compute, 60), 'value')
+            if tier != bench.CASSANDRA:
+                lock = cache.make_key('soft') + REFRESH_SUFFIX
+                self.assertEquals(cache._cache.get(lock), None)
+                # another process is refreshing it
+                cache._cache.add(lock, 1, 30)
+                self.assertEquals(cache.get_or_set('soft', compute, 60, soft_timeout=0), 2)
+                while cache._refresher.running() and time.time() < deadline:
+                    time.sleep(0.01)
+                self.assertEquals(cache.get('soft'), 2)
+                self.assertEquals(len(calls), 3)
+
+class LargeValueTests(TestCase):
+
+    def test_large_values(self):
+        for tier in bench.TIERS:
+            cache = bench.make_backend(tier, {'large_value_threshold': 1000, 'large_value_chunk_size': 300})
+            big = 'x' * 2000
+            cache.set('big', big)
+            cache.set_many({'big2': big, 'small': 'value'})
+            self.assertEquals(cache.get('big'), big)
+            self.assertEquals(cache.get_many(['big', 'big2', 'small']), {'big': big, 'big2': big, 'small': 'value'})
+            if tier == bench.DUAL:
+                memcached = cache._cache
+                self.assertEquals(memcached.get(cache.make_key('big')), LARGE_MARKER)
+                self.assertEquals(memcached.get(cache.make_key('big2')), LARGE_MARKER)
+                self.assertEquals(memcached.get(cache.make_key('small')), 'value')
+            cache.set('big', 'small now')
+            self.assertEquals(cache.get('big'), 'small now')
+            cache.set('small', big[:1500])
+            self.assertEquals(cache.get('small'), big[:1500])
+            self.assertTrue(cache.add('added', big))
+            self.assertFalse(cache.add('added', 'other'))
+            self.assertEquals(cache.get('added'), big)
+        cache = bench.make_backend(bench.DUAL, {'large_value_threshold': 1000, 'negative_timeout': 60})
+        memcached = cache._cache
+        self.assertEquals(memcached.get(cache.make_key('added')), None)
+        self.assertEquals(cache.get('added'), None)
+        self.assertTrue(cache.add('added', big))
+        self.assertEquals(memcached.get(cache.make_key('added')), LARGE_MARKER)
+        self.assertEquals(cache.get('added'), big)
+        self.assertFalse(cache.add('added', 'other'))
+        # with nowhere else to go it has to be memcached
+        cache.set('hot', big, tier='memcached_only')
+        self.assertEquals(memcached.get(cache.make_key('hot')), big)
+        self.assertEquals(cache.get('hot'), big)
+
+    def test_replaced_chunks_removed(self):
+        cache = bench.make_backend(bench.CASSANDRA, {'large_value_threshold': 1000, 'large_value_chunk_size': 300})
+        rows = cache._cf._rows
+        cache.set('big', 'x' * 5000)
+        cache.set_many({'big2': 'x' * 5000})
+        self.assertEquals(len([name for name in rows[cache.make_key('big')] if name.startswith('chunk:')]), 17)
+        cache.set('big', 'x' * 2000)
+        self.assertEquals(len([name for name in rows[cache.make_key('big')] if name.startswith('chunk:')]), 7)
+        cache.set('big', 'small')
+        cache.set_many({'big2': 'small'})
+        self.assertEquals(sorted(rows[cache.make_key('big')]), ['exp', 'val'])
+        self.assertEquals(sorted(rows[cache.make_key('big2')]), ['exp', 'val'])
+        self.assertEquals(cache.get_many(['big', 'big2']), {'big': 'small', 'big2': 'small'})
+
+class MemcachedOnlyTests(TestCase):
+
+    def test_memcached_only(self):
+        cache = bench.make_backend(bench.MEMCACHED)
+        self.assertEquals(cache.get.__name__, '_memcached_only_get')
+        self.assertFalse(bench.make_backend(bench.DUAL)._memcached_only)
+        self.assertFalse(bench.make_backend(bench.MEMCACHED, {'l0_max_entries': 100})._memcached_only)
+        self.assertTrue(cache.add('key', 'value'))
+        self.assertFalse(cache.add('key', 'other'))
+        self.assertEquals(cache.get('key', tier='cassandra_only'), None)
+        cache.set('key', 'value', tier='cassandra_only')
+        self.assertEquals(cache.get('key'), None)
+        self.assertEquals(cache.get_or_set('soft', lambda: 'computed', 60), 'computed')
+        self.assertEquals(cache.get_many(['soft', 'key']), {'soft': 'computed'})
+        cache.set('counter', 5)
+        self.assertEquals(cache.decr('counter', 2), 3)
+        self.assertRaises(ValueError, cache.incr, 'missing')
+
+class ExpiryTests(TestCase):
+
+    def _memcached_lifetime(self, cache, akey):
+        # seconds until the fake memcached expires akey
+        return cache._cache._data[cache.make_key(akey)][1] - time.time()
+
+    def test_backfill_keeps_remaining_lifetime(self):
+        cache = bench.make_backend(bench.DUAL)
+        cache.set('key', 'value', 600)
+        cache.set('other', 'value', 600)
+        cache._cache.flush_all()
+        self.assertEquals(cache.get('key'), 'value')
+        self.assertTrue(595 <= self._memcached_lifetime(cache, 'key') <= 600)
+        self.assertEquals(cache.get_many(['other']), {'other': 'value'})
+        # get_many rounds down to the minute, so that a batch shares expiry times
+        self.assertTrue(535 <= self._memcached_lifetime(cache, 'other') <= 600)
+
+    def test_backfill_without_expiry_uses_default_timeout(self):
+        cache = bench.make_backend(bench.DUAL)
+        cache.set('key', 'value', 600)
+        cache.set('other', 'value', 600)
+        for akey in ('key', 'other'):
+            # written before the exp column was
+            del cache._cf._rows[cache.make_key(akey)]['exp']
+        cache._cache.flush_all()
+        self.assertEquals(cache.get('key'), 'value')
+        self.assertTrue(3595 <= self._memcached_lifetime(cache, 'key') <= 3600)
+        self.assertEquals(cache.get_many(['other']), {'other': 'value'})
+        self.assertTrue(3595 <= self._memcached_lifetime(cache, 'other') <= 3600)
+
+    def test_counter_backfill_uses_default_timeout(self):
+        cache = bench.make_backend(bench.DUAL)
+        cache.set('counter', 1, 600)
+        cache.incr('counter')
+        cache._cache.flush_all()
+        self.assertEquals(cache.get('counter'), 2)
+        self.assertTrue(3595 <= self._memcached_lifetime(cache, 'counter') <= 3600)
+
+class LayoutTests(TestCase):
+
+    def test_tagged_layout(self):
+        cache = bench.make_backend(bench.CASSANDRA, {'layout': 'tagged'})
+        cache.set('key', 'value')
+        cache.set('counter', 1)
+        with mock.patch.object(cache._countercf, 'get', wraps=cache._countercf.get) as counter_get:
+            self.assertEquals(cache.get('key'), 'value')
+            self.assertEquals(cache.get('missing'), None)
+            self.assertEquals(cache.get('counter'), 1)
+            # one read of the value row each
+            self.assertFalse(counter_get.called)
+            self.assertEquals(cache.incr('counter'), 2)
+            self.assertEquals(cache.get('counter'), 2)
+            self.assertTrue(counter_get.called)
+        self.assertEquals(cache.get_many(['key', 'counter', 'missing']), {'key': 'value', 'counter': 2})
+
+    def test_migrate_to_tagged_layout(self):
+        split = bench.make_backend(bench.CASSANDRA)
+        split.set('key', 'value')
+        split.set('counter', 1, 60)
+        split.incr('counter')
+        # the value row expires, the counter doesn't
+        split._cf.remove(split.make_key('counter'))
+        self.assertEquals(split.get('counter'), 2)
+        tagged = bench.make_backend(bench.CASSANDRA, {'layout': 'tagged'})
+        cacheandra._connections[tagged._connection_key()] = cacheandra._connections[split._connection_key()]
+        self.assertEquals(tagged.get('counter'), None)
+        self.assertEquals(tagged.migrate_to_tagged_layout(), 1)
+        self.assertEquals(tagged.get('counter'), 2)
+        self.assertEquals(tagged.get_many(['key', 'counter']), {'key': 'value', 'counter': 2})
+        self.assertEquals(tagged.migrate_to_tagged_layout(), 1)
+        self.assertEquals(tagged.incr('counter'), 3)
+        self.assertEquals(tagged.get('counter'), 3)
+
+class CounterModeTests(TestCase):
+
+    def test_fast_counters(self):
+        cache = bench.make_backend(bench.DUAL, {'counter_mode': 'fast'})
+        cache.set('counter', 5)
+        self.assertEquals(cache.incr('counter'), 6)
+        self.assertEquals(cache.decr('counter', 2), 4)
+        self.assertEquals(cache.incr('counter', 10), 14)
+        # cassandra heard about every change
+        cache._cache.flush_all()
+        self.assertEquals(cache.get('counter'), 14)
+        self.assertEquals(cache.get_many(['counter']), {'counter': 14})
+
+    def test_counter_flush_interval(self):
+        cache = bench.make_backend(bench.DUAL, {'counter_mode': 'fast', 'counter_flush_interval': 60000})
+        cache.set('counter', 5)
+        cache.set('other', 1)
+        self.assertEquals(cache.incr('counter'), 6)
+        self.assertEquals(cache.incr('counter', 3), 9)
+        self.assertEquals(cache.decr('other'), 0)
+        self.assertEquals(cache.counter_stats()['pending'], 2)
+        cache._counters.flush()
+        self.assertEquals(cache.counter_stats(), {'pending': 0, 'flushes': 1, 'errors': 0})
+        cache._cache.flush_all()
+        self.assertEquals(cache.get_many(['counter', 'other']), {'counter': 9, 'other': 0})
+        # a read from cassandra sends what's waiting for the key first
+        self.assertEquals(cache.incr('counter'), 10)
+        self.assertEquals(cache.incr('other'), 1)
+        cache._cache.flush_all()
+        self.assertEquals(cache.get('counter'), 10)
+        self.assertEquals(cache.get_many(['other']), {'other': 1})
+        self.assertEquals(cache.counter_stats()['pending'], 0)
+
+    def test_set_and_delete_take_waiting_changes(self):
+        cache = bench.make_backend(bench.DUAL, {'counter_mode': 'fast', 'counter_flush_interval': 60000})
+        cache.set('counter', 5)
+        cache.set('other', 5)
+        cache.incr('counter')
+        cache.incr('other')
+        cache.set('counter', 100)
+        cache.delete('other')
+        self.assertEquals(cache.counter_stats()['pending'], 0)
+        cache._counters.flush()
+        cache._cache.flush_all()
+        self.assertEquals(cache.get('counter'), 100)
+        self.assertEquals(cache.get('other'), None)
+
+class GetManyTests(TestCase):
+
+    def test_failed_chunks_miss(self):
+        cache = bench.make_backend(bench.CASSANDRA, {'get_many_chunk_size': 2})
+        data = dict(('key%d' % i, i) for i in range(10))
+        cache.set_many(data)
+        # two of the five chunks fail
+        cache._cf.latency = bench.Latency(failure_rate=0.5, seed=0)
+        with mock.patch('cacheandra.cacheandra.logger') as logger:
+            ret = cache.get_many(data.keys())
+        self.assertEquals(len(ret), 6)
+        self.assertTrue(all(data[k] == v for k, v in ret.iteritems()))
+        self.assertEquals(logger.exception.call_count, 2)
+        # the keys that failed weren't taken to be missing
+        cache._cf.latency = bench.Latency()
+        self.assertEquals(cache.get_many(data.keys()), data)
+
+class KeyTests(TestCase):
+
+    def test_key_transform(self):
+        transform = KeyTransform('ns', hash_threshold=40)
+        self.assertEquals(transform(':1:key'), 'ns::1:key')
+        long_key = transform(':1:' + 'x'*100)
+        self.assertTrue(long_key.startswith('ns:'))
+        self.assertEquals(len(long_key), 35)
+        self.assertEquals(transform(':1:' + 'x'*100), long_key)
+        self.assertNotEquals(transform(':1:' + 'x'*99 + 'y'), long_key)
+
+    def test_key_distribution(self):
+        report = key_distribution(['key%d' % i for i in range(1000)], ['a:11211', 'b:11211'], ranges=4)
+        self.assertEquals(sum(report['memcached'].values()), 1000)
+        self.assertEquals(sum(report['cassandra']), 1000)
+        self.assertTrue(report['spread']['cassandra'] < 1.5)
+        report = key_distribution(['key%d' % i for i in range(1000)], ranges=4, partitioner=MURMUR3_PARTITIONER)
+        self.assertEquals(sum(report['cassandra']), 1000)
+        self.assertTrue(report['spread']['cassandra'] < 1.5)
+
+    def test_murmur3_tokens(self):
+        # as cassandra's token() gives them
+        self.assertEquals(cassandra_token('', MURMUR3_PARTITIONER), 0)
+        self.assertEquals(cassandra_token('a', MURMUR3_PARTITIONER), -8839064797231613815)
+        self.assertEquals(cassandra_token('hello world', MURMUR3_PARTITIONER), 5998619086395760910)
+        self.assertEquals(cassandra_token('0123456789abcdefghijklmnopq', MURMUR3_PARTITIONER), 4541646684555425035)
+
+    def test_cache_keys(self):
+        cache = get_cache('cacheandra.cacheandra.CacheBackend', **{
+            'LOCATION': '127.0.0.1:11211',
+            'CASSANDRA': '127.0.0.1',
+            'OPTIONS': dict(key_namespace='test', key_hash_threshold=100),
+        })
+        long_key = 'x' * 300
+        cache.set(long_key, 'value')
+        cache.set('counter', 1)
+        self.assertEquals(cache.get(long_key), 'value')
+        self.assertEquals(cache.get_many([long_key, 'counter']), {long_key: 'value', 'counter': 1})
+        self.assertEquals(cache.incr('counter'), 2)
+        cache.delete_many([long_key, 'counter'])
+        self.assertEquals(cache.get(long_key), None)
+
+class StartupTests(TestCase):
+
+    def test_lazy_module(self):
+        json = LazyModule('json')
+        self.assertEquals(json.loads('[1]'), [1])
+        self.assertTrue('dumps' in json.__dict__)
+
+    def test_bench_main_times_startup(self):
+        fd, output = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        self.addCleanup(os.remove, output)
+        with mock.patch('sys.stdout'):
+            bench.main(['--filter', 'startup', '--startup-runs', '1', '--startup-target', '100000',
+                        '--overhead-iterations', '0', '--output', output])
+        with open(output) as f:
+            self.assertEquals(sorted(json.load(f)), ['startup/import', 'startup/setup'])
+        # the documented way to run it
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(path or os.getcwd() for path in sys.path))
+        del env['DJANGO_SETTINGS_MODULE']
+        subprocess.check_output([sys.executable, '-m', bench.__name__, '--filter', 'startup', '--startup-runs', '1',
+                                 '--startup-target', '100000', '--overhead-iterations', '0', '--output', output],
+                                env=env)
+        with open(output) as f:
+            self.assertEquals(sorted(json.load(f)), ['startup/import', 'startup/setup'])
+
+    def test_lazy_connect(self):
+        patched = mock.patch.multiple(cacheandra.pycassa, ConnectionPool=mock.DEFAULT, ColumnFamily=mock.DEFAULT)
+        with patched as mocks, mock.patch('cacheandra.cacheandra.logger'):
+            pool = mocks['ConnectionPool']
+            pool.side_effect = pycassa.AllServersUnavailable('down')
+            cache = get_cache('cacheandra.cacheandra.CacheBackend', **{
+                'CASSANDRA': '10.255.255.1',
+                'KEYSPACE': 'unreachable',
+            })
+            self.assertEquals(cache._connection, None)
+            self.assertFalse(pool.called)
+            # the first call that needs cassandra connects, and a failure is a miss
+            self.assertEquals(cache.get('key', tier='cassandra_only'), None)
+            self.assertEquals(pool.call_count, 1)
+
+class ConnectionTests(TestCase):
+
+    def test_connections_not_shared_across_options(self):
+        one = bench.make_backend(bench.CASSANDRA)
+        params = {'CASSANDRA': one._cassandra_servers, 'KEYSPACE': one._keyspace, 'COLUMNFAMILY': one._columnfamilyname}
+        same = get_cache('cacheandra.cacheandra.CacheBackend', **params)
+        self.assertEquals(same._connection_key(), one._connection_key())
+        for options in ({'read_consistency': 'QUORUM'}, {'write_consistency': 'ALL'}, {'pool_size': 1}):
+            other = get_cache('cacheandra.cacheandra.CacheBackend', **dict(params, OPTIONS=options))
+            self.assertNotEquals(other._connection_key(), one._connection_key())
+        self.assertTrue(same._cf is one._cf)
+
+    def test_pool_retried_after_failed_connect(self):
+        cache = get_cache('cacheandra.cacheandra.CacheBackend', **{
+            'CASSANDRA': ['127.0.0.1:1'],
+            'KEYSPACE': 'retry',
+            'OPTIONS': dict(pool_retry_interval=0.2),
+        })
+        patched = mock.patch.multiple(cacheandra.pycassa, ConnectionPool=mock.DEFAULT, ColumnFamily=mock.DEFAULT)
+        with patched as mocks, mock.patch('cacheandra.cacheandra.logger'):
+            pool = mocks['ConnectionPool']
+            pool.side_effect = pycassa.AllServersUnavailable('down')
+            self.assertEquals(cache._connect(), (None, None))
+            self.assertEquals(pool.call_count, 1)
+            # not tried again until pool_retry_interval has passed
+            self.assertEquals(cache._connect(), (None, None))
+            self.assertEquals(pool.call_count, 1)
+            time.sleep(0.25)
+            pool.side_effect = None
+            cf, countercf = cache._connect()
+            self.assertEquals(pool.call_count, 2)
+            self.assertTrue(cf is not None and countercf is not None)
+            self.assertTrue(cache._cf is cf)
+            self.assertEquals(pool.call_count, 2)
+
+class HotKeyTests(TestCase):
+
+    def test_sketch(self):
+        sketch = CountMinSketch(64, 4)
+        for i in range(100):
+            sketch.add('hot')
+        for i in range(200):
+            sketch.add('key%d' % i)
+        self.assertTrue(sketch.estimate('hot') >= 100)
+        self.assertTrue(sketch.estimate('key1') < 100)
+        sketch.halve()
+        self.assertTrue(50 <= sketch.estimate('hot') < 100)
+
+    def test_hot_keys(self):
+        cache = bench.make_backend(bench.DUAL, {'hot_key_replicas': 3, 'hot_key_threshold': 5, 'hot_key_sample_rate': 1})
+        memcached = cache._cache
+        key = cache.make_key('hot')
+        cache.set('hot', 'value')
+        cache.set('cold', 'value')
+        for i in range(20):
+            self.assertEquals(cache.get('hot'), 'value')
+        self.assertEquals(cache.get('cold'), 'value')
+        self.assertEquals(cache.hot_keys(), frozenset([key]))
+        cache.set('hot', 'new')
+        for n in range(1, 4):
+            self.assertEquals(memcached.get(replica_key(key, n)), 'new')
+        self.assertEquals(cache.get_many(['hot', 'cold']), {'hot': 'new', 'cold': 'value'})
+        # reads fall back to the key itself while a copy isn't there
+        memcached.delete(replica_key(key, 1))
+        for i in range(20):
+            self.assertEquals(cache.get('hot'), 'new')
+        cache.delete('hot')
+        for n in range(1, 4):
+            self.assertEquals(memcached.get(replica_key(key, n)), None)
+        self.assertEquals(cache.get('hot'), None)
+        self.assertEquals(bench.make_backend(bench.DUAL).hot_keys(), None)
+
+    def test_writes_elsewhere_reach_copies(self):
+        options = {'hot_key_replicas': 3, 'hot_key_threshold': 5, 'hot_key_sample_rate': 1}
+        hot = bench.make_backend(bench.DUAL, options)
+        # another process, with the same memcached and cassandra, where the key isn't hot
+        other = bench.make_backend(bench.DUAL, options)
+        other._local = hot._local
+        cacheandra._connections[other._connection_key()] = cacheandra._connections[hot._connection_key()]
+        hot.set('hot', 'v1')
+        for i in range(20):
+            self.assertEquals(hot.get('hot'), 'v1')
+        self.assertEquals(hot.hot_keys(), frozenset([hot.make_key('hot')]))
+        self.assertEquals(other.hot_keys(), frozenset())
+        other.set('hot', 'v2')
+        self.assertEquals(set(hot.get('hot') for i in range(20)), set(['v2']))
+        self.assertEquals(hot.get_many(['hot']), {'hot': 'v2'})
+        other.delete('hot')
+        self.assertEquals(set(hot.get('hot') for i in range(20)), set([None]))
+        self.assertEquals(hot.get_many(['hot']), {})
@@ -0,0 +1,37 @@
+"""
+Warming memcached from cassandra for cacheandra
+"""
+
+from multiprocessing import Pool
+
+from django.core.cache import get_cache
+
+from .keys import token_ranges
+
+def _warm_range(args):
+    cache, start_token, finish_token, prefix, batch_size, rate = args
+    return get_cache(cache).warm(start_token, finish_token, prefix, batch_size=batch_size, rate=rate)
+
+def warm(cache='default', prefix=None, keys=None, processes=4, batch_size=100, rate=0):
+    """
+    Copies the values and counters of the cache called cache (an alias in CACHES) from cassandra into memcached.
+    With keys, only those cache keys are copied. Otherwise the token ring is split into ranges that
+    processes worker processes read at the same time, copying the keys that start with prefix, as stored -
+    ':1:user' for example with django's default key function. The ranges follow the cache's partitioner, and
+    ValueError is raised for one they can't be worked out for. rate limits the keys written a second, across
+    all the processes. Returns the number of keys copied.
+    """
+    if keys is not None:
+        return get_cache(cache).warm(keys=keys, batch_size=batch_size, rate=rate)
+    if processes <= 1:
+        return get_cache(cache).warm(prefix=prefix, batch_size=batch_size, rate=rate)
+    # more ranges than processes, so a process that gets a sparse range moves on to another
+    ranges = token_ranges(processes * 4, get_cache(cache).partitioner())
+    rate = float(rate) / processes if rate else 0
+    pool = Pool(processes)
+    try:
+        return sum(pool.map(_warm_range, [(cache, start, finish, prefix, batch_size, rate)
+                                          for start, finish in ranges], chunksize=1))
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,258 @@
+"""
+Background writes to cassandra for cacheandra
+"""
+
+import atexit
+import logging
+import os
+import time
+from collections import OrderedDict
+from threading import Condition, Lock, Thread
+
+from .registry import per_location
+
+logger = logging.getLogger(__name__)
+
+_queues = {}
+
+def get_write_behind_queue(location, **kwargs):
+    return per_location(_queues, (location, tuple(sorted(kwargs.items()))), lambda: WriteBehindQueue(**kwargs))
+
+class WriteBehindQueue(object):
+    """
+    A bounded queue of writes, keyed by cache key, drained in batches by a pool of daemon threads. Each write
+    is queued with the function that makes it, and the writes in a batch are handed to their functions as
+    write(list of writes) - so backends sharing the queue each write their own. A write to a key that is still
+    queued replaces the queued one.
+
+    put() waits up to put_timeout for room when the queue is full and then gives up, so the caller can
+    make the write itself. flush() waits for everything queued so far to be written, and helps write it. The threads are started
+    on first use, and again in a process forked after they were started.
+    """
+
+    def __init__(self, max_size=10000, workers=2, batch_size=100, put_timeout=0.05):
+        self.max_size = max_size
+        self.workers = workers
+        self.batch_size = batch_size
+        self.put_timeout = put_timeout
+        self._cond = Condition()
+        self._pending = OrderedDict()
+        self._writing = 0
+        self._pid = None
+        self.written = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.errors = 0
+        atexit.register(self.flush)
+
+    def _start(self):
+        # called holding the lock
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._pending.clear()
+        self._writing = 0
+        for i in range(self.workers):
+            t = Thread(target=self._run, name='cacheandra-write-behind-%d' % i)
+            t.daemon = True
+            t.start()
+
+    def put(self, key, write, func):
+        """
+        Queues write for key, to be made by func. Returns False if the queue stayed full, in which case nothing
+        was queued.
+        """
+        with self._cond:
+            self._start()
+            if key in self._pending:
+                self._pending[key] = (func, write)
+                self.coalesced += 1
+                return True
+            deadline = time.time() + self.put_timeout
+            while len(self._pending) >= self.max_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.rejected += 1
+                    return False
+                self._cond.wait(remaining)
+            self._pending[key] = (func, write)
+            self._cond.notify_all()
+            return True
+
+    def get(self, key):
+        """
+        The write queued for key, or None.
+        """
+        with self._cond:
+            queued = self._pending.get(key)
+            return queued and queued[1]
+
+    def take(self, key):
+        """
+        Removes the write queued for key and returns it, or None.
+        """
+        with self._cond:
+            queued = self._pending.pop(key, None)
+            if queued is None:
+                return None
+            self._cond.notify_all()
+            return queued[1]
+
+    def discard_all(self):
+        with self._cond:
+            self._pending.clear()
+            self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Waits until everything queued has been written, for at most timeout seconds if given. Without a
+        timeout the calling thread writes batches too, so it finishes however busy or slow the workers are.
+        Returns True if the queue is empty.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            batch = None
+            with self._cond:
+                if not self._pending and not self._writing:
+                    return True
+                if self._pid != os.getpid():
+                    # nothing is writing in this process
+                    return not self._pending
+                if deadline is None and self._pending:
+                    batch = self._take_batch()
+                else:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    # wake now and again in case a worker has died
+                    self._cond.wait(1 if remaining is None else min(remaining, 1))
+            if batch is not None:
+                self._write(batch)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'depth': len(self._pending),
+                'writing': self._writing,
+                'written': self.written,
+                'coalesced': self.coalesced,
+                'rejected': self.rejected,
+                'errors': self.errors,
+            }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                batch = self._take_batch()
+            self._write(batch)
+
+    def _take_batch(self):
+        # called holding the lock
+        batch = []
+        while self._pending and len(batch) < self.batch_size:
+            batch.append(self._pending.popitem(last=False)[1])
+        self._writing += 1
+        self._cond.notify_all()
+        return batch
+
+    def _write(self, batch):
+        written = 0
+        try:
+            writes = OrderedDict()
+            for func, write in batch:
+                writes.setdefault(func, []).append(write)
+            for func, batch_writes in writes.iteritems():
+                try:
+                    func(batch_writes)
+                    written += len(batch_writes)
+                except Exception as e:
+                    logger.exception("Cacheandra write behind failed %r", e)
+        finally:
+            with self._cond:
+                self._writing -= 1
+                self.written += written
+                self.errors += len(batch) - written
+                self._cond.notify_all()
+
+_aggregators = {}
+
+def get_counter_aggregator(location, interval):
+    return per_location(_aggregators, (location, interval), lambda: CounterAggregator(interval))
+
+class CounterAggregator(object):
+    """
+    Sums counter changes per key in memory, and every interval seconds hands the totals to the functions that
+    were given with them, as write(dict of key -> delta), from a daemon thread. take() removes a key's total so
+    the caller can deal with it now. The thread is started on first use, and again in a process forked after
+    it was started.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = Lock()
+        self._deltas = {}
+        self._pid = None
+        self.flushes = 0
+        self.errors = 0
+        atexit.register(self.flush)
+
+    def _start(self):
+        # called holding the lock
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._deltas = {}
+        t = Thread(target=self._run, name='cacheandra-counters')
+        t.daemon = True
+        t.start()
+
+    def add(self, key, delta, write):
+        with self._lock:
+            self._start()
+            deltas = self._deltas.setdefault(write, {})
+            deltas[key] = deltas.get(key, 0) + delta
+
+    def take(self, key):
+        """
+        Removes the total waiting for key and returns it, 0 if there isn't one
+        """
+        with self._lock:
+            return sum(deltas.pop(key, 0) for deltas in self._deltas.itervalues())
+
+    def discard_all(self):
+        with self._lock:
+            self._deltas = {}
+
+    def flush(self):
+        """
+        Writes everything that has built up
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            writes, self._deltas = self._deltas, {}
+        for write, deltas in writes.iteritems():
+            deltas = dict((key, delta) for key, delta in deltas.iteritems() if delta)
+            if not deltas:
+                continue
+            try:
+                write(deltas)
+                self.flushes += 1
+            except Exception as e:
+                logger.exception("Cacheandra counter flush failed %r", e)
+                self.errors += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': sum(len(deltas) for deltas in self._deltas.itervalues()),
+                'flushes': self.flushes,
+                'errors': self.errors,
+            }
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()